@@ -1,24 +1,24 @@
 from typing import List
-from scrapers.query import PaginatedQuery, QueryResult
+from scrapers.query import PaginatedQuery, QueryResult, Window
 
 class ILQuery(PaginatedQuery):
     MAX_LIMIT = 200
     BASE_URL = "https://iltalehti.fi/"
     API_URL = "https://api.il.fi/v1/articles/search"
 
-    def build_url(self) -> str:
+    def build_url(self, window: Window) -> str:
         return self.API_URL
     
-    def build_params(self):
+    def build_params(self, window: Window):
         return {
-            "date_start": self.params.from_date.strftime("%Y-%m-%d"),
-            "date_end": self.params.to_date.strftime("%Y-%m-%d"),
+            "date_start": window.from_date.strftime("%Y-%m-%d"),
+            "date_end": window.to_date.strftime("%Y-%m-%d"),
             "q": self.params.query,
-            "offset": self.offset,
+            "offset": window.offset,
             "limit": self.params.limit
         }
     
-    def parse_response(self, r):
+    def parse_response(self, r, window: Window):
         ans: List[QueryResult] = []
 
         for a in r["response"]:
@@ -0,0 +1,94 @@
+import asyncio
+import contextlib
+import logging
+import random
+import time
+from typing import AsyncIterator, Dict, MutableMapping, Optional
+
+import aiohttp
+
+logger = logging.getLogger("http_client")
+
+# Koko sovelluksen yhteinen HTTP-asiakas. Sama ClientSession ja yhteyspooli jaetaan kaikkien toimeksiantojen kesken,
+# jolloin yhteydet ja DNS-haut käytetään uudelleen, eikä yksikään palvelin saa liikaa samanaikaisia yhteyksiä.
+
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 8
+DNS_CACHE_SECONDS = 300
+KEEPALIVE_SECONDS = 30
+
+# Palvelukohtaiset aikarajat
+TIMEOUTS: Dict[str, aiohttp.ClientTimeout] = {
+    "search": aiohttp.ClientTimeout(total=60, sock_connect=10),
+    "fetch": aiohttp.ClientTimeout(total=30, sock_connect=10),
+    "twitter": aiohttp.ClientTimeout(total=60, sock_connect=10),
+    "parser": aiohttp.ClientTimeout(total=300, sock_connect=10),
+    "ner": aiohttp.ClientTimeout(total=120, sock_connect=10),
+    "annif": aiohttp.ClientTimeout(total=60, sock_connect=10),
+}
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=60, sock_connect=10)
+
+# Vastauskoodit, joiden jälkeen pyyntö yritetään uudelleen
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRIES = 3
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 900.0
+
+def create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTION_LIMIT,
+        limit_per_host=CONNECTION_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_SECONDS,
+        keepalive_timeout=KEEPALIVE_SECONDS,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=DEFAULT_TIMEOUT, trust_env=True)
+
+# aiohttp-sovelluksen cleanup_ctx, joka luo yhteisen istunnon käynnistyksessä ja sulkee sen sammutuksessa
+async def client_session(app: MutableMapping):
+    async with create_session() as session:
+        app["client_session"] = session
+        yield
+
+def _retry_delay(attempt: int, response: Optional[aiohttp.ClientResponse]) -> float:
+    delay = BACKOFF_SECONDS * 2**attempt * (1 + random.random())
+    if response is not None:
+        if response.headers.get("Retry-After", "").isdigit():
+            delay = float(response.headers["Retry-After"])
+
+        elif response.status == 429 and response.headers.get("x-rate-limit-reset", "").isdigit():
+            # Twitter kertoo, milloin kyselykiintiö nollautuu. Otsake on jokaisessa vastauksessa, joten sitä
+            # käytetään vain, kun kiintiö on oikeasti täynnä; palvelinvirheet odotetaan eksponentiaalisesti.
+            delay = float(response.headers["x-rate-limit-reset"]) - time.time() + 1
+
+    return min(max(delay, 0), MAX_BACKOFF_SECONDS)
+
+# Tekee pyynnön palvelun aikarajalla ja yrittää uudelleen eksponentiaalisesti kasvavin tauoin, jos yhteys epäonnistuu
+# tai palvelin vastaa tilapäisellä virheellä. Viimeisen yrityksen vastaus palautetaan sellaisenaan.
+@contextlib.asynccontextmanager
+async def request(session: aiohttp.ClientSession, method: str, url: str, service: str, retries: int = RETRIES, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+    kwargs.setdefault("timeout", TIMEOUTS.get(service, DEFAULT_TIMEOUT))
+    attempt = 0
+    while True:
+        response = None
+        try:
+            response = await session.request(method, url, **kwargs)
+            if response.status not in RETRY_STATUSES or attempt >= retries:
+                break
+
+            logger.warning(f"Got response code {response.status} from {service} ({url}), retrying...")
+            response.release()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            if attempt >= retries:
+                raise
+
+            logger.warning(f"Request to {service} ({url}) failed: {ex!r}, retrying...")
+
+        await asyncio.sleep(_retry_delay(attempt, response))
+        attempt += 1
+
+    try:
+        yield response
+
+    finally:
+        response.release()
@@ -0,0 +1,105 @@
+from typing import Any, List
+
+import lxml.etree
+import lxml.html
+import soupsieve
+from bs4 import BeautifulSoup
+from bs4.element import CData, NavigableString, Tag
+
+try:
+    from cssselect import HTMLTranslator, SelectorError
+except ImportError:
+    HTMLTranslator = None
+
+# Artikkelien poiminnan apufunktiot. CSS-valitsimet käännetään kerran. Jos cssselect on asennettu, valitsimet
+# käännetään XPath-lausekkeiksi ja sivut jäsennetään suoraan lxml:llä, mikä on moninkertaisesti nopeampaa kuin
+# BeautifulSoup. Valitsimet, joita cssselect ei tue, ajetaan BeautifulSoupilla ja soupsievellä. Molemmat tavat
+# tuottavat saman tekstin (ks. python -m server.benchmark_extract).
+
+# Elementit, joiden tekstiä BeautifulSoupin get_text ei palauta
+_SKIPPED_TAGS = {"script", "style", "template"}
+
+_PARSER = lxml.html.HTMLParser(encoding="utf-8")
+
+class Selector:
+    def __init__(self, css: str):
+        self.css = css
+        self.soupsieve = soupsieve.compile(css)
+        self.xpath = None
+        if HTMLTranslator:
+            try:
+                # BeautifulSoupin select ei palauta elementtiä itseään, joten haetaan vain jälkeläisistä
+                self.xpath = lxml.etree.XPath(HTMLTranslator().css_to_xpath(css, prefix="descendant::"))
+
+            except (SelectorError, lxml.etree.XPathError):
+                pass
+
+def use_lxml(selectors: List[Selector]) -> bool:
+    return all(selector.xpath is not None for selector in selectors)
+
+def parse(html: str, selectors: List[Selector]) -> Any:
+    if use_lxml(selectors):
+        return lxml.html.fromstring(html.encode("utf-8"), parser=_PARSER)
+
+    return BeautifulSoup(html, "lxml")
+
+def select(root: Any, selector: Selector) -> list:
+    if isinstance(root, lxml.etree._Element):
+        return selector.xpath(root)
+
+    return selector.soupsieve.select(root)
+
+def select_one(root: Any, selector: Selector) -> Any:
+    elements = select(root, selector)
+    return elements[0] if elements else None
+
+def remove(element: Any):
+    if isinstance(element, lxml.etree._Element):
+        # drop_tree säilyttää elementin perässä olevan tekstin kuten BeautifulSoupin extract
+        element.drop_tree()
+
+    else:
+        element.extract()
+
+# Palauttaa elementin tekstin kuten BeautifulSoupin get_text. Jos `block_tags` on annettu, jokaisen lohkoelementin
+# perään lisätään `separator`.
+def get_text(element: Any, block_tags: frozenset = frozenset(), separator: str = "") -> str:
+    parts: List[str] = []
+    if isinstance(element, lxml.etree._Element):
+        _collect_lxml_text(element, block_tags, separator, parts)
+
+    elif block_tags:
+        _collect_soup_text(element, block_tags, separator, parts)
+
+    else:
+        return element.get_text()
+
+    return "".join(parts)
+
+def _collect_lxml_text(element: lxml.etree._Element, block_tags: frozenset, separator: str, parts: List[str]):
+    if element.tag in _SKIPPED_TAGS:
+        return
+
+    if element.text:
+        parts.append(element.text)
+
+    for child in element:
+        # Kommenttien ja käsittelyohjeiden tag ei ole merkkijono
+        if isinstance(child.tag, str):
+            _collect_lxml_text(child, block_tags, separator, parts)
+            if child.tag in block_tags:
+                parts.append(separator)
+
+        if child.tail:
+            parts.append(child.tail)
+
+def _collect_soup_text(element: Tag, block_tags: frozenset, separator: str, parts: List[str]):
+    for child in element.children:
+        if isinstance(child, Tag):
+            _collect_soup_text(child, block_tags, separator, parts)
+            if child.name in block_tags:
+                parts.append(separator)
+
+        # get_text palauttaa vain nämä merkkijonotyypit (ei esim. kommentteja tai skriptejä)
+        elif type(child) in (NavigableString, CData):
+            parts.append(str(child))
@@ -1,32 +1,47 @@
 import json
 import logging
-from typing import List, NamedTuple, Optional, Tuple
-from bs4 import BeautifulSoup
+from typing import Dict, List, NamedTuple, Optional, Pattern, Tuple
+from urllib.parse import urlparse
 import re
 import aiohttp
 
+from scrapers import client
+from scrapers.extract import Selector, get_text, parse, select
+
 logger = logging.getLogger("news_fetch")
 
 class FetchSelectors(NamedTuple):
+    host: str
     url_regex: str
     article: str
     persons: str
 
 SELECTORS: List[FetchSelectors] = [
-    FetchSelectors(r"https?://yle.fi/.*", 
+    FetchSelectors("yle.fi", r"https?://yle.fi/.*", 
         article=".yle__article__heading--h1, .yle__article__paragraph",
         persons=".yle__article__quote__source, .yle__article__strong:not(:first-child:last-child)"
     ),
-    FetchSelectors(r"https://www.is.fi/.*", 
+    FetchSelectors("www.is.fi", r"https://www.is.fi/.*", 
         article=".article-title-40, .article-ingress-20, p.article-body",
         persons=".article-personlink"
     ),
-    FetchSelectors(r"https://iltalehti.fi/.*", 
+    FetchSelectors("iltalehti.fi", r"https://iltalehti.fi/.*", 
         article=".article-headline, .article-description, .article-body .paragraph",
         persons="p.paragraph strong"
     ),
 ]
 
+class CompiledSelectors(NamedTuple):
+    url_regex: Pattern
+    article: Selector
+    persons: Selector
+
+# Sivustot haetaan osoitteen isäntänimellä, ja valitsimet käännetään vain kerran
+COMPILED_SELECTORS: Dict[str, CompiledSelectors] = {
+    site.host: CompiledSelectors(re.compile(site.url_regex), Selector(site.article), Selector(site.persons))
+    for site in SELECTORS
+}
+
 class FetchResult(NamedTuple):
     content: str
     persons: List[str]
@@ -45,32 +60,29 @@ class FetchResult(NamedTuple):
             "persons": self.persons,
         })
 
-async def css_fetch(url: str, session: aiohttp.ClientSession) -> Optional[FetchResult]:
+async def fetch_html(url: str, session: aiohttp.ClientSession) -> Optional[str]:
     logger.info(f"Fetching {url}")
-    async with session.get(url) as response:
+    async with client.request(session, "GET", url, "fetch") as response:
         if response.status != 200:
             logger.error(f"Got unexpected response code {response.status} for {response.url}.")
             return None
         
-        s = BeautifulSoup(await response.text(), "lxml")
+        return await response.text()
 
-        article = ""
-        persons = []
-        for site in SELECTORS:
-            if re.fullmatch(site.url_regex, url):
-                texts = s.select(site.article)
-                if texts:
-                    for text in texts:
-                        article += text.get_text() + "\n"
-                
-                texts = s.select(site.persons)
-                if texts:
-                    for text in texts:
-                        persons.append(text.get_text())
-                
-                break
-        
-        else:
-            logger.error(f"No known CSS selectors for {response.url}.")
-        
-        return FetchResult(content=article, persons=persons)
\ No newline at end of file
+def extract(url: str, html: str) -> FetchResult:
+    site = COMPILED_SELECTORS.get(urlparse(url).hostname)
+    if not site or not site.url_regex.fullmatch(url):
+        logger.error(f"No known CSS selectors for {url}.")
+        return FetchResult(content="", persons=[])
+    
+    root = parse(html, [site.article, site.persons])
+    article = "".join(get_text(text) + "\n" for text in select(root, site.article))
+    persons = [get_text(text) for text in select(root, site.persons)]
+    return FetchResult(content=article, persons=persons)
+
+async def css_fetch(url: str, session: aiohttp.ClientSession) -> Optional[FetchResult]:
+    html = await fetch_html(url, session)
+    if html is None:
+        return None
+    
+    return extract(url, html)
@@ -3,10 +3,13 @@ import datetime
 import aiohttp
 import logging
 import random
+from collections import deque
 from time import sleep
 import pandas
 
-from typing import NamedTuple, Optional, TypedDict, List
+from scrapers import client
+
+from typing import AsyncIterator, Deque, Dict, NamedTuple, Optional, Protocol, TypedDict, List
 
 logger = logging.getLogger("news_query")
 
@@ -26,71 +29,269 @@ class Params(NamedTuple):
     enabled: List[str] = []
     extra: dict = {}
 
-DATE_DELTA = datetime.timedelta(weeks=1)
+ONE_DAY = datetime.timedelta(days=1)
+
+# Hakuikkunan tila pidetään erillään kyselyolioista, jotta saman kyselyn ikkunoita voi hakea rinnakkain. Molemmat
+# päivämäärät kuuluvat ikkunaan.
+class Window(NamedTuple):
+    from_date: datetime.date
+    to_date: datetime.date
+    offset: int = 0
+
+class Page(NamedTuple):
+    results: List[QueryResult]
+    # Rajapinnan ilmoittama osumien kokonaismäärä, jos rajapinta kertoo sen
+    total: Optional[int] = None
+    cached: bool = False
+
+# Hakutulossivujen välimuisti. Palvelin antaa kyselylle tietokantaan tallentavan toteutuksen.
+class PageCache(Protocol):
+    async def load(self, key: str) -> Optional[Page]: ...
+
+    async def save(self, key: str, window: Window, page: Page): ...
+
+# Kokonainen kalenteriviikko maanantaista sunnuntaihin
+def _whole_week(window: Window) -> bool:
+    return window.from_date.weekday() == 0 and window.to_date == window.from_date + datetime.timedelta(days=6)
+
+# Rajapintakohtaiset semaforit, jotka rajoittavat samanaikaisia pyyntöjä kaikkien saman rajapinnan kyselyjen kesken
+_semaphores: Dict[type, asyncio.Semaphore] = {}
 
 class PaginatedQuery:
     MAX_LIMIT = 100
-    offset: int = 0
+    # Samanaikaisten pyyntöjen enimmäismäärä rajapintaa kohden
+    CONCURRENCY = 4
+    # Suurin määrä tuloksia, jonka rajapinta palauttaa yhdestä kyselystä; None, jos rajaa ei ole
+    RESULT_CAP: Optional[int] = None
+    # Yhdistetyn ikkunan enimmäispituus päivinä
+    MAX_WINDOW_DAYS = 366
 
-    def __init__(self, params: Params):
+    def __init__(self, params: Params, cache: Optional[PageCache] = None):
         if params.limit == 0:
             params = params._replace(limit = self.MAX_LIMIT)
 
         self.params = params
+        self.cache = cache
     
-    def build_url(self) -> str:
+    def build_url(self, window: Window) -> str:
         raise NotImplementedError
     
-    def build_params(self) -> Optional[dict]:
+    def build_params(self, window: Window) -> Optional[dict]:
         return None
 
-    def parse_response(self, response) -> List[QueryResult]:
+    def parse_response(self, response, window: Window) -> List[QueryResult]:
         raise NotImplementedError
     
-    async def _scrape_page(self, session: aiohttp.ClientSession) -> List[QueryResult]:
-        url = self.build_url()
-        params = self.build_params()
-        async with session.get(url, params=params) as response:
-            logger.info(f"Processing articles {self.params.from_date.isoformat()}..{self.params.to_date.isoformat()} from {response.url}")
+    def total_hits(self, response) -> Optional[int]:
+        return None
+    
+    # Aikaväli jaetaan aluksi kalenteriviikkoihin (maanantaista sunnuntaihin), joten eri toimeksiantojen ikkunat ja
+    # niiden välimuistiavaimet ovat samat ja päättyneiden viikkojen sivut löytyvät välimuistista. Harvojen osumien
+    # viikot yhdistetään haettaessa (ks. merge) ja liian tiheät ikkunat puolitetaan, joten harvoihin osumiin riittää
+    # muutama pyyntö ja tiheätkin haut saadaan kokonaan.
+    def windows(self) -> List[Window]:
+        windows = []
+        date = self.params.from_date
+        while date <= self.params.to_date:
+            end = date + datetime.timedelta(days=6 - date.weekday())
+            windows.append(Window(date, min(end, self.params.to_date)))
+            date = end + ONE_DAY
+
+        return windows
+    
+    # Viikon rajan ylittävä ikkuna puolitetaan lähimmältä viikon rajalta, jotta puolikkaatkin ovat kokonaisia
+    # kalenteriviikkoja
+    @staticmethod
+    def split(window: Window) -> List[Window]:
+        middle = window.from_date + (window.to_date - window.from_date) // 2
+        end_of_week = middle + datetime.timedelta(days=6 - middle.weekday())
+        if end_of_week < window.to_date:
+            middle = end_of_week
+
+        return [Window(window.from_date, middle), Window(middle + ONE_DAY, window.to_date)]
+    
+    def capped(self, page: Page) -> bool:
+        return self.RESULT_CAP is not None and page.total is not None and page.total > self.RESULT_CAP
+    
+    # Yhdistää ikkunaan seuraavia odottavia kokonaisia viikkoja. Yhdistetyt ikkunat ovat aina 2^k kokonaista viikkoa ja
+    # alkavat viikosta, jonka järjestysnumero on jaollinen 2^k:lla, joten eri toimeksiannot yhdistävät samat viikot
+    # samoiksi ikkunoiksi ja käyttävät samoja välimuistin sivuja. Välimuistissa oleva suurin tällainen ikkuna käytetään
+    # aina. Muuten ikkunan koko valitaan edellisen vajaaksi jääneen ikkunan osumatiheyden perusteella niin, että
+    # yhdistetty ikkuna täyttäisi korkeintaan puoli sivua, eikä välimuistissa olevia viikkoja yhdistetä.
+    async def merge(self, window: Window, pending: Deque[Window], density: Optional[float]) -> Window:
+        if not _whole_week(window):
+            return window
+
+        weeks = [window]
+        for week in pending:
+            if week.from_date != weeks[-1].to_date + ONE_DAY or not _whole_week(week):
+                break
+
+            weeks.append(week)
+
+        # Viikon järjestysnumero ajanlaskun alusta (date(1, 1, 1) on maanantai)
+        index = (window.from_date.toordinal() - 1) // 7
+        sizes = []
+        size = 2
+        while size <= len(weeks) and index % size == 0 and size * 7 <= self.MAX_WINDOW_DAYS:
+            sizes.append(size)
+            size *= 2
+
+        for size in reversed(sizes):
+            merged = Window(window.from_date, weeks[size - 1].to_date)
+            sparse = density is not None and density * size * 7 <= self.params.limit / 2
+            if await self._cached(merged) or (sparse and not any([await self._cached(week) for week in weeks[:size]])):
+                for _ in range(size - 1):
+                    pending.popleft()
+
+                return merged
+
+        return window
+    
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if type(self) not in _semaphores:
+            _semaphores[type(self)] = asyncio.Semaphore(self.CONCURRENCY)
+        
+        return _semaphores[type(self)]
+    
+    def cache_key(self, window: Window) -> str:
+        return f"{type(self).__name__} {self.params.query} {window.from_date.isoformat()}..{window.to_date.isoformat()} {self.params.limit} {window.offset}"
+    
+    async def _cached(self, window: Window) -> bool:
+        return self.cache is not None and await self.cache.load(self.cache_key(window)) is not None
+    
+    async def _scrape_page(self, session: aiohttp.ClientSession, window: Window) -> Page:
+        if self.cache:
+            page = await self.cache.load(self.cache_key(window))
+            if page:
+                logger.info(f"Using cached articles {window.from_date.isoformat()}..{window.to_date.isoformat()} at offset {window.offset}")
+                return page
+        
+        page = await self._fetch_page(session, window)
+        if page is None:
+            return Page([])
+        
+        if self.cache:
+            await self.cache.save(self.cache_key(window), window, page)
+        
+        return page
+    
+    async def _fetch_page(self, session: aiohttp.ClientSession, window: Window) -> Optional[Page]:
+        url = self.build_url(window)
+        params = self.build_params(window)
+        async with self.semaphore, client.request(session, "GET", url, "search", params=params) as response:
+            logger.info(f"Processing articles {window.from_date.isoformat()}..{window.to_date.isoformat()} from {response.url}")
             if response.status != 200:
                 logger.error(f"Got unexpected response code {response.status} for {response.url}.")
-                return []
+                return None
             
             r = await response.json()
             if r is None:
                 logger.error(f"Got empty response for {response.url}")
-                return []
+                return None
             
-            return self.parse_response(r)
+            return Page(self.parse_response(r, window), self.total_hits(r))
 
-    async def _scrape(self, session: aiohttp.ClientSession) -> list:
-        data = []
-        while True:
-            new_data = await self._scrape_page(session)
-            if not new_data:
-                break
+    # Palauttaa ikkunan tulosten määrän tai None, jos ikkuna jouduttiin puolittamaan
+    async def _scrape_window(self, session: aiohttp.ClientSession, window: Window, pages: asyncio.Queue) -> Optional[int]:
+        limit = self.params.limit
+        page = await self._scrape_page(session, window)
+        capped = self.capped(page)
+        probes: Dict[int, Page] = {}
+        # Jos rajapinta ei kerro osumien määrää, täyden ensimmäisen sivun jälkeen haetaan viimeinen sallittu sivu. Jos
+        # sekin on täysi, ikkuna puolitetaan heti eikä sen sivuja haeta turhaan loppuun asti.
+        if not capped and page.total is None and self.RESULT_CAP and len(page.results) >= limit and self.RESULT_CAP > limit:
+            last = window._replace(offset = self.RESULT_CAP - limit)
+            probes[last.offset] = await self._scrape_page(session, last)
+            capped = len(probes[last.offset].results) >= limit
+
+        if capped:
+            if window.from_date < window.to_date:
+                logger.info(f"Too many results for {window.from_date.isoformat()}..{window.to_date.isoformat()}, splitting the window")
+                await asyncio.gather(*(self._scrape_window(session, half, pages) for half in self.split(window)))
+                return None
+            
+            logger.error(f"Query results in more than {self.RESULT_CAP} results on {window.from_date.isoformat()}. The API refuses to return more results, so some results are missing.")
 
-            data += new_data
+        count = 0
+        while page.results:
+            count += len(page.results)
+            await pages.put(page.results)
 
-            if len(new_data) < self.params.limit:
+            if len(page.results) < limit or (self.RESULT_CAP and window.offset + limit >= self.RESULT_CAP):
                 break
 
-            self.offset += self.params.limit
+            window = window._replace(offset = window.offset + limit)
 
-            await asyncio.sleep(random.random()*self.params.delay*2)
+            if not page.cached:
+                await asyncio.sleep(random.random()*self.params.delay*2)
+
+            page = probes.pop(window.offset, None) or await self._scrape_page(session, window)
         
-        logger.info(f"Processed {len(data)} articles in total.")
+        logger.info(f"Processed {count} articles in total.")
+        return count
+    
+    # Palauttaa hakutulokset sivu kerrallaan heti, kun ne saapuvat. Aikaikkunoita haetaan rinnakkain, joten sivut
+    # eivät tule päivämääräjärjestyksessä. Jo palautetut URL-osoitteet suodatetaan pois, joten erät eivät sisällä
+    # kaksoiskappaleita.
+    async def iter_results(self, session: aiohttp.ClientSession) -> AsyncIterator[List[QueryResult]]:
+        pages: asyncio.Queue = asyncio.Queue(self.CONCURRENCY * 2)
+
+        pending = deque(self.windows())
+        # Viimeksi haetun vajaaksi jääneen ikkunan osumia päivää kohden; None, jos tiheyttä ei tiedetä tai ikkuna oli täysi
+        density: Optional[float] = None
+
+        async def scrape_windows():
+            nonlocal density
+            while pending:
+                window = await self.merge(pending.popleft(), pending, density)
+                count = await self._scrape_window(session, window, pages)
+                if count is not None and count < self.params.limit:
+                    density = count / ((window.to_date - window.from_date).days + 1)
+
+                else:
+                    density = None
+
+        async def scrape_all():
+            try:
+                await asyncio.gather(*(scrape_windows() for _ in range(self.CONCURRENCY)))
+            
+            except asyncio.CancelledError:
+                # Kuluttaja on lopettanut, joten lopetusmerkkiä ei odota kukaan (ja jono voi olla täynnä)
+                raise
+            
+            except Exception:
+                await pages.put(None)
+                raise
+            
+            await pages.put(None)
+
+        task = asyncio.create_task(scrape_all())
+        try:
+            seen = set()
+            while (page := await pages.get()) is not None:
+                batch = []
+                for result in page:
+                    if result["url"] not in seen:
+                        seen.add(result["url"])
+                        batch.append(result)
+                
+                if batch:
+                    yield batch
+            
+            # Nostaa haun aikana tapahtuneen virheen
+            await task
         
-        return data
+        finally:
+            # Odotetaan perutun haun loppumista, jottei se jää roikkumaan. Haun virhe on jo nostettu tai sillä ei ole
+            # enää merkitystä.
+            task.cancel()
+            await asyncio.wait([task])
     
     async def scrape(self, session: aiohttp.ClientSession) -> pandas.DataFrame:
-        date = self.params.from_date
-        to_date = self.params.to_date
-
         data = []
-        while date < to_date:
-            self.params = self.params._replace(from_date = date, to_date = date+DATE_DELTA)
-            data += await self._scrape(session)
-            date += DATE_DELTA
+        async for batch in self.iter_results(session):
+            data += batch
 
-        return pandas.DataFrame(data).drop_duplicates("url")
+        return pandas.DataFrame(data)
@@ -1,35 +1,39 @@
 import asyncio
 import contextlib
+import json
+import os
 import re
 import sys
+import time
 from datetime import date, datetime
 from typing import Dict, List, Optional
+from urllib.parse import urlparse
 
+import aiohttp
 import pyppeteer
-from bs4 import BeautifulSoup
-from bs4.element import NavigableString
 from pyppeteer.browser import Browser
 from pyppeteer.element_handle import ElementHandle
 from pyppeteer.page import Page
 import pyppdf.patch_pyppeteer
 
-from scrapers.fetch import FetchResult, logger as fetch_logger
-from scrapers.query import PaginatedQuery, Params, QueryResult, logger as query_logger
+from scrapers import client
+from scrapers.extract import Selector, get_text, parse, remove, select, select_one
+from scrapers.fetch import FetchResult, extract, logger as fetch_logger
+from scrapers.query import PaginatedQuery, Params, QueryResult, Window
 
 class HSQuery(PaginatedQuery):
     MAX_LIMIT = 100
+    CONCURRENCY = 2
+    RESULT_CAP = 10000
     BASE_URL = "https://www.hs.fi"
     API_URL = "https://www.hs.fi/api/search"
 
-    def build_url(self) -> str:
-        date_start = int(datetime.timestamp(datetime.combine(self.params.from_date, datetime.min.time())) * 1000)
-        date_end = int(datetime.timestamp(datetime.combine(self.params.to_date if self.params.to_date is not None else date.today(), datetime.max.time())) * 1000)
-        return f"{self.API_URL}/{self.params.query}/kaikki/custom/new/{self.offset}/{self.params.limit}/{date_start}/{date_end}"
+    def build_url(self, window: Window) -> str:
+        date_start = int(datetime.timestamp(datetime.combine(window.from_date, datetime.min.time())) * 1000)
+        date_end = int(datetime.timestamp(datetime.combine(window.to_date if window.to_date is not None else date.today(), datetime.max.time())) * 1000)
+        return f"{self.API_URL}/{self.params.query}/kaikki/custom/new/{window.offset}/{self.params.limit}/{date_start}/{date_end}"
     
-    def parse_response(self, r):
-        if self.offset >= 9900:
-            query_logger.error(f"Query results in more than 9900 results. The Sanoma API refuses to return more than 10000 results, so some results are missing. You can work around this limitation by doing multiple queries on smaller timespans.")
-            
+    def parse_response(self, r, window: Window):
         ans: List[QueryResult] = []
         for a in r:
             if "nakoislehti.hs.fi" in a["href"]:
@@ -50,27 +54,130 @@ class ISQuery(HSQuery):
     API_URL = "https://www.is.fi/api/search"
 
 @contextlib.asynccontextmanager
-async def create_hs_session(username: str, password: str):
-    hs_fetch = HSFetch(username, password)
+async def create_hs_session(username: str, password: str, tabs: int = 1, cookie_file: Optional[str] = None):
+    hs_fetch = HSFetch(username, password, tabs, cookie_file)
     await hs_fetch.login()
     yield hs_fetch
     await hs_fetch.close()
 
+# Kirjautumisen evästeet tallennetaan tiedostoon, jotta selaimen ei tarvitse kirjautua uudelleen ennen kuin evästeet
+# vanhenevat. Niillä voi myös hakea artikkeleita suoraan ilman selainta. Vanhentuneet evästeet (esim. lyhytikäiset
+# suostumus- ja analytiikkaevästeet) jätetään pois; kirjautumisen voimassaolo tarkistetaan erikseen (HSFetch.login).
+def load_cookies(path: str) -> Optional[List[dict]]:
+    if not os.path.exists(path):
+        return None
+    
+    with open(path, "r") as f:
+        cookies = json.load(f)
+    
+    now = time.time()
+    cookies = [cookie for cookie in cookies if not 0 < cookie.get("expires", -1) < now]
+    return cookies or None
+
+def save_cookies(path: str, cookies: List[dict]):
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        json.dump(cookies, f)
+
+def _cookie_header(url: str, cookies: List[dict]) -> str:
+    host = urlparse(url).hostname or ""
+    return "; ".join(
+        f"{cookie['name']}={cookie['value']}"
+        for cookie in cookies
+        if host == cookie["domain"].lstrip(".") or host.endswith("." + cookie["domain"].lstrip("."))
+    )
+
+_PAID_CONTENT = re.compile(r"""class=["']paywall-content["']|id=["']paid-content["']""")
+
+# Hakee artikkelin ilman selainta. Palauttaa None, jos sivun HTML ei sisällä maksumuurin takaista sisältöä, jolloin
+# artikkeli pitää hakea selaimella.
+async def fetch_html_with_cookies(url: str, session: aiohttp.ClientSession, cookies: List[dict]) -> Optional[str]:
+    try:
+        async with client.request(session, "GET", url, "fetch", headers={"Cookie": _cookie_header(url, cookies)}) as response:
+            if response.status != 200:
+                return None
+            
+            html = await response.text()
+    
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        fetch_logger.warning(f"Failed to fetch {url} without a browser", exc_info=sys.exc_info())
+        return None
+    
+    return html if _PAID_CONTENT.search(html) else None
+
+# Artikkeleita haettaessa ei ladata kuvia, fontteja, mediaa eikä mainos- ja analytiikkapalveluiden resursseja. Muut
+# resurssit (esim. HS:n omilta CDN-palvelimilta ladattavat skriptit, joita maksumuurin kehys tarvitsee) ladataan.
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+BLOCKED_DOMAINS = (
+    "doubleclick.net",
+    "googlesyndication.com",
+    "googletagservices.com",
+    "googletagmanager.com",
+    "google-analytics.com",
+    "adnxs.com",
+    "adform.net",
+    "amazon-adsystem.com",
+    "criteo.com",
+    "criteo.net",
+    "rubiconproject.com",
+    "pubmatic.com",
+    "casalemedia.com",
+    "teads.tv",
+    "outbrain.com",
+    "taboola.com",
+    "facebook.net",
+    "facebook.com",
+    "scorecardresearch.com",
+    "gemius.pl",
+    "chartbeat.com",
+    "chartbeat.net",
+    "cxense.com",
+    "hotjar.com",
+    "kilkaya.com",
+)
+
+def _is_blocked_host(url: str) -> bool:
+    host = urlparse(url).hostname or ""
+    return any(host == domain or host.endswith("." + domain) for domain in BLOCKED_DOMAINS)
+
+# Kuinka monen peräkkäin epäonnistuneen haun jälkeen tarkistetaan, onko kirjautuminen vielä voimassa
+RELOGIN_AFTER_FAILURES = 3
+
 class HSFetch:
     browser: Optional[Browser]
     page: Optional[Page]
 
-    def __init__(self, username: str, password: str):
+    def __init__(self, username: str, password: str, tabs: int = 1, cookie_file: Optional[str] = None):
         self.browser = None
         self.page = None
         self.username = username
         self.password = password
+        self.cookie_file = cookie_file
+        self.cookies = load_cookies(cookie_file) if cookie_file else None
+        self.n_tabs = tabs
+        # Kirjautuneet välilehdet. Välilehdet jakavat selaimen evästeet, joten kirjautuminen riittää yhdellä.
+        self.tabs: asyncio.Queue = asyncio.Queue()
+        self.failures = 0
+        self.login_lock = asyncio.Lock()
     
     async def login(self):
         if not self.browser:
             self.browser = await pyppeteer.launch(headless=True, args=["--no-sandbox", "--disable-gpu"])
 
         page = await self.browser.newPage()
+        if self.cookies:
+            fetch_logger.info("Using saved HS login cookies.")
+            await page.setCookie(*self.cookies)
+        
+        # Palvelin on voinut mitätöidä tallennetun istunnon, vaikka evästeet eivät ole vanhentuneet
+        if not self.cookies or not await self._logged_in(page):
+            await self._login(page)
+        
+        self.page = page
+        for tab in [page] + [await self.browser.newPage() for _ in range(self.n_tabs - 1)]:
+            await self._block_resources(tab)
+            self.tabs.put_nowait(tab)
+    
+    async def _login(self, page: Page):
         fetch_logger.info("Logging into HS.")
         await page.goto("https://www.hs.fi")
         try:
@@ -93,49 +200,131 @@ class HSFetch:
         await submit.click()
         await asyncio.sleep(10)
         fetch_logger.info("Logged in.")
-
-        self.page = page
+        self.cookies = await page.cookies()
+        if self.cookie_file:
+            save_cookies(self.cookie_file, self.cookies)
+    
+    # Kirjautumaton etusivu näyttää kirjautumislinkin
+    async def _logged_in(self, page: Page) -> bool:
+        try:
+            await page.goto("https://www.hs.fi", waitUntil="networkidle2")
+            logged_in = await page.querySelector("a[href*=start-login]") is None
+        
+        except:
+            fetch_logger.error("Failed to check the HS login", exc_info=sys.exc_info())
+            return False
+        
+        if not logged_in:
+            fetch_logger.info("Saved HS login is no longer valid.")
+        
+        return logged_in
+    
+    # Jos hakuja epäonnistuu peräkkäin, istunto on voinut vanhentua kesken toimeksiannon
+    async def _check_login(self, tab: Page):
+        async with self.login_lock:
+            if self.failures < RELOGIN_AFTER_FAILURES:
+                return
+            
+            self.failures = 0
+            if not await self._logged_in(tab):
+                await self._login(tab)
+    
+    async def _block_resources(self, tab: Page):
+        await tab.setRequestInterception(True)
+        tab.on("request", lambda request: asyncio.ensure_future(self._intercept(request)))
+    
+    async def _intercept(self, request):
+        try:
+            if request.resourceType in BLOCKED_RESOURCE_TYPES or _is_blocked_host(request.url):
+                await request.abort()
+            
+            else:
+                await request.continue_()
+        
+        except:
+            # Pyyntö on voinut jo päättyä, jos välilehti siirtyi toiselle sivulle
+            fetch_logger.debug(f"Failed to intercept {request.url}", exc_info=sys.exc_info())
     
     async def close(self):
         if self.browser:
             await self.browser.close()
 
-    async def fetch_hs(self, url: str) -> Optional[FetchResult]:
+    async def fetch_html(self, url: str) -> Optional[str]:
         fetch_logger.info(f"Fetching {url}")
+        tab = await self.tabs.get()
         try:
-            await self.page.goto(url)
-            dynamic_content: ElementHandle = await self.page.waitForXPath("//div[@id='page-main-content']/following-sibling::*")
+            await tab.goto(url)
+            dynamic_content: ElementHandle = await tab.waitForXPath("//div[@id='page-main-content']/following-sibling::*")
             if await (await dynamic_content.getProperty("tagName")).jsonValue() == "IFRAME":
                 frame = await dynamic_content.contentFrame()
                 await frame.waitForXPath("//div[@class='paywall-content']|//div[@id='paid-content']")
-                content = await frame.content()
+                html = await frame.content()
             else:
-                content = await self.page.content()
-            
-            return self._parse_hs(content)
+                html = await tab.content()
+            self.failures = 0
+            return html
         except:
             fetch_logger.exception(f"Failed to fetch {url}.", exc_info=sys.exc_info())
+            self.failures += 1
+            if self.failures >= RELOGIN_AFTER_FAILURES:
+                try:
+                    await self._check_login(tab)
+                
+                except:
+                    fetch_logger.error("Failed to log into HS again", exc_info=sys.exc_info())
+            
+            return None
+        finally:
+            self.tabs.put_nowait(tab)
+
+    async def fetch_hs(self, url: str) -> Optional[FetchResult]:
+        html = await self.fetch_html(url)
+        if html is None:
             return None
+        
+        return parse_hs(html)
 
-    def _parse_hs(self, html: str) -> FetchResult:
-        soup = BeautifulSoup(html, "lxml")
+_HS_PERSONS = Selector(".article-personlink")
+_HS_MAIN = Selector("main")
+_HS_ARTICLE = Selector("div#page-main-content + article")
+_HS_CONTENT = Selector("div#page-main-content")
+_HS_ASIDE = Selector("aside")
+_HS_REMOVED = Selector("section.article-body + div, div.article-info, div.related-articles, div.article-actions, div.paywallWrapper")
+_HS_SELECTORS = [_HS_PERSONS, _HS_MAIN, _HS_ARTICLE, _HS_CONTENT, _HS_ASIDE, _HS_REMOVED]
+_HS_BLOCK_TAGS = frozenset(["h1", "h2", "h3", "h4", "h5", "h6", "h7", "p", "div"])
 
-        persons = soup.select(".article-personlink")
-        persons = [] if not persons else [p.get_text() for p in persons]
+def parse_hs(html: str) -> FetchResult:
+    root = parse(html, _HS_SELECTORS)
 
-        soup = soup.find("main") or soup
-        soup = soup.select_one("div#page-main-content + article") or soup.select_one("div#page-main-content") or soup
-        for elem in soup.find_all("aside"):
-            elem.extract()
-        
-        for elem in soup.select("section.article-body + div, div.article-info, div.related-articles, div.article-actions, div.paywallWrapper"):
-            elem.extract()
-        
-        for tag in ["h1", "h2", "h3", "h4", "h5", "h6", "h7", "p", "div"]:
-            for p in soup.find_all(tag):
-                p.insert_after(NavigableString("\n\n"))
-        
-        text: str = soup.get_text().replace("\xad", "")
-        text = re.sub("\n\n+", "\n\n", text)
+    persons = [get_text(p) for p in select(root, _HS_PERSONS)]
 
-        return FetchResult(content=text, persons=persons)
+    # lxml-elementin totuusarvo kertoo, onko sillä lapsia, joten puuttuvat elementit tarkistetaan None-vertailulla
+    main = select_one(root, _HS_MAIN)
+    if main is not None:
+        root = main
+    
+    content = select_one(root, _HS_ARTICLE)
+    if content is None:
+        content = select_one(root, _HS_CONTENT)
+    
+    if content is not None:
+        root = content
+    
+    for elem in select(root, _HS_ASIDE):
+        remove(elem)
+    
+    for elem in select(root, _HS_REMOVED):
+        remove(elem)
+    
+    # Lohkoelementtien perään lisätään kappaleenvaihto
+    text = get_text(root, _HS_BLOCK_TAGS, "\n\n").replace("\xad", "")
+    text = re.sub("\n\n+", "\n\n", text)
+
+    return FetchResult(content=text, persons=persons)
+
+# Valitsee sivuston mukaisen poimijan. Käytetään, kun artikkelit poimitaan uudelleen tallennetusta HTML:stä.
+def extract_article(url: str, html: str) -> FetchResult:
+    if re.fullmatch(r"https?://www.hs.fi/.*", url):
+        return parse_hs(html)
+    
+    return extract(url, html)
@@ -0,0 +1,165 @@
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import zlib
+from typing import IO, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("tweet_store")
+
+# Tviittitiedostot ovat pakattua NDJSONia. Jokainen Twitterin vastaussivu kirjoitetaan omana lohkonaan:
+#
+#     {"type": "page", "count": 3, "min_created_at": "...", "max_created_at": "..."}
+#     {"type": "tweet", "data": {...}}
+#     {"type": "tweet", "data": {...}}
+#     {"type": "user", "data": {...}}
+#
+# Sivun otsakkeen avulla lukija voi ohittaa päivämäärävälin ulkopuolelle jäävät sivut jäsentämättä niitä.
+# Tiedostoon voi lisätä sivuja myöhemmin, koska sekä gzip että zstd sallivat pakattujen osien ketjuttamisen.
+#
+# Kirjoittaja kirjoittaa sivut ensin `.part`-tiedostoon, jota lukijat eivät näe. Kun kirjoittaja suljetaan, valmis
+# pakattu osa siirretään tiedoston nimelle tai lisätään olemassa olevan tiedoston perään väliaikaisen kopion kautta,
+# joten lukijat näkevät vain kokonaisia pakattuja osia. Jos tiedoston viimeinen osa on silti katkennut (esim. vanhat
+# tiedostot), lukeminen lopetetaan siihen.
+
+EXTENSIONS = [".ndjson.zst", ".ndjson.gz", ".json"]
+PART_SUFFIX = ".part"
+
+# Poikkeukset, jotka tarkoittavat katkennutta pakattua osaa
+TRUNCATED_ERRORS = (EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+def default_extension() -> str:
+    return ".ndjson.zst" if zstandard else ".ndjson.gz"
+
+def _open(path: str, mode: str) -> IO[bytes]:
+    if path.endswith(".zst") or path.endswith(".zst" + PART_SUFFIX):
+        if not zstandard:
+            raise RuntimeError(f"zstandard is required to read {path}")
+
+        if mode == "rb":
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+
+        return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+
+    return gzip.open(path, mode)
+
+# Siirtää valmiin `.part`-tiedoston lopulliselle nimelle tai lisää sen olemassa olevan tiedoston perään
+def _publish(part: str, path: str):
+    if not os.path.exists(path):
+        os.replace(part, path)
+        return
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as out:
+        for source in (path, part):
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, out)
+
+    os.replace(tmp, path)
+    os.remove(part)
+
+class TweetWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.file: Optional[IO[bytes]] = None
+        self.max_id = 0
+        self.n_tweets = 0
+
+    def __enter__(self) -> "TweetWriter":
+        self.file = _open(self.path + PART_SUFFIX, "wb")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            _publish(self.path + PART_SUFFIX, self.path)
+
+    def write_page(self, tweets: List[dict], users: List[dict]):
+        if not tweets and not users:
+            return
+
+        created_at = [tweet["created_at"] for tweet in tweets if "created_at" in tweet]
+        lines = [json.dumps({
+            "type": "page",
+            "count": len(tweets) + len(users),
+            "min_created_at": min(created_at, default=None),
+            "max_created_at": max(created_at, default=None),
+        })]
+        lines += [json.dumps({"type": "tweet", "data": tweet}) for tweet in tweets]
+        lines += [json.dumps({"type": "user", "data": user}) for user in users]
+        self.file.write(("\n".join(lines) + "\n").encode("utf-8"))
+        self.file.flush()
+
+        self.n_tweets += len(tweets)
+        self.max_id = max([self.max_id] + [int(tweet["id"]) for tweet in tweets])
+
+def find_tweet_file(directory: str, name: str) -> Optional[str]:
+    for extension in EXTENSIONS:
+        path = os.path.join(directory, name + extension)
+        if os.path.exists(path):
+            return path
+
+    return None
+
+def list_tweet_files(directory: str) -> List[str]:
+    return sorted(
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if any(filename.endswith(extension) for extension in EXTENSIONS)
+    )
+
+# Palauttaa tiedoston tietueet pareina `("tweet", tviitti)` tai `("user", käyttäjä)`. Jos `from_date` tai `to_date`
+# (ISO-muotoisia merkkijonoja) on annettu, ohitetaan sivut, joiden kaikki tviitit ovat välin ulkopuolella. Vanhat
+# `.json`-tiedostot luetaan kokonaan ilman suodatusta.
+def iter_tweet_file(path: str, from_date: Optional[str] = None, to_date: Optional[str] = None) -> Iterator[Tuple[str, dict]]:
+    if path.endswith(".json"):
+        with open(path, "r") as f:
+            data = json.load(f)
+
+        for user in data["users"].values():
+            yield "user", user
+
+        for tweet in data["tweets"].values():
+            yield "tweet", tweet
+
+        return
+
+    with _open(path, "rb") as raw, io.TextIOWrapper(raw, encoding="utf-8") as f:
+        lines = _complete_lines(path, f)
+        for line in lines:
+            record = json.loads(line)
+            if record["type"] == "page":
+                skip = (
+                    (from_date and record["max_created_at"] and record["max_created_at"] < from_date) or
+                    (to_date and record["min_created_at"] and record["min_created_at"] > to_date)
+                )
+                if skip:
+                    for _ in range(record["count"]):
+                        if next(lines, None) is None:
+                            return
+
+            else:
+                yield record["type"], record["data"]
+
+# Palauttaa tiedoston kokonaiset rivit ja lopettaa katkenneeseen viimeiseen pakattuun osaan tai riviin
+def _complete_lines(path: str, f: IO[str]) -> Iterator[str]:
+    try:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+
+            yield line
+
+    except TRUNCATED_ERRORS:
+        logger.warning(f"Tweet file {path} ends with a truncated block, ignoring the rest of the file")
@@ -1,15 +1,24 @@
 import asyncio
 import datetime
 import re
-import sys
-from typing import List, Tuple
+from typing import AsyncIterator, List, Optional, Tuple
 import aiohttp
 import logging
 
+from scrapers import client
+from scrapers.tweet_store import TweetWriter
+
 logger = logging.getLogger("twitter_scraper")
 
 twitter_lock = asyncio.Lock()
 
+# Full-archive search -rajapinnan kyselyn enimmäispituus
+MAX_QUERY_LENGTH = 1024
+
+# Kysely keskeytyi ennen viimeistä sivua, joten osa tuloksista puuttuu
+class TwitterQueryError(Exception):
+    pass
+
 async def get_tweets_with_url(url: str, start_date: datetime.datetime, end_date: datetime.datetime, session: aiohttp.ClientSession, bearer: str) -> List[dict]:
     if '"' in url:
         logger.error(f"Illegal characters in url: {url}")
@@ -18,21 +27,61 @@ async def get_tweets_with_url(url: str, start_date: datetime.datetime, end_date:
     tweets, _users = await query_tweets(f"url:\"{url}\" lang:fi", start_date, end_date, session, bearer, included_tweets=False)
     return list(tweets.values())
 
-async def query_by_username(usernames: List[str], start_date: datetime.datetime, end_date: datetime.datetime, session: aiohttp.ClientSession, bearer: str) -> Tuple[dict, dict]:
+async def query_by_username(usernames: List[str], start_date: datetime.datetime, end_date: datetime.datetime, session: aiohttp.ClientSession, bearer: str, since_id: Optional[str] = None, writer: Optional[TweetWriter] = None) -> Tuple[dict, dict]:
+    terms = []
     for username in usernames:
         if not re.fullmatch(r"[a-zA-Z0-9_]{1,15}", username):
             logger.error(f"Illegal characters in Twitter username: {username}")
-            return ({}, {})
+            continue
+        
+        terms.append(f"from:\"{username}\"")
     
-    query = " OR ".join(f"from:\"{username}\"" for username in usernames)
-    return await query_tweets(f"({query}) lang:fi", start_date, end_date, session, bearer, included_tweets=False)
+    return await query_packed(terms, "lang:fi", start_date, end_date, session, bearer, since_id=since_id, writer=writer)
 
 async def query_by_search_word(search_word: str, start_date: datetime.datetime, end_date: datetime.datetime, session: aiohttp.ClientSession, bearer: str) -> Tuple[dict, dict]:
-    if '"' in search_word:
-        logger.error(f"Illegal characters in search word: {search_word}")
-        return ({}, {})
+    return await query_by_search_words([search_word], start_date, end_date, session, bearer)
+
+async def query_by_search_words(search_words: List[str], start_date: datetime.datetime, end_date: datetime.datetime, session: aiohttp.ClientSession, bearer: str, since_id: Optional[str] = None, writer: Optional[TweetWriter] = None) -> Tuple[dict, dict]:
+    terms = []
+    for search_word in search_words:
+        if '"' in search_word:
+            logger.error(f"Illegal characters in search word: {search_word}")
+            continue
+        
+        terms.append(f"\"{search_word}\"")
+    
+    return await query_packed(terms, "lang:fi", start_date, end_date, session, bearer, since_id=since_id, writer=writer)
+
+async def query_packed(terms: List[str], suffix: str, start_date: datetime.datetime, end_date: datetime.datetime, session: aiohttp.ClientSession, bearer: str, since_id: Optional[str] = None, writer: Optional[TweetWriter] = None) -> Tuple[dict, dict]:
+    tweets = {}
+    users = {}
+    queries = pack_queries(terms, suffix)
+    for i, query in enumerate(queries):
+        logger.info(f"{i+1}/{len(queries)} Querying {query}")
+        query_tweets_, query_users = await query_tweets(query, start_date, end_date, session, bearer, included_tweets=False, since_id=since_id, writer=writer)
+        tweets.update(query_tweets_)
+        users.update(query_users)
+    
+    return tweets, users
+
+def pack_queries(terms: List[str], suffix: str, max_length: int = MAX_QUERY_LENGTH) -> List[str]:
+    # Yhdistetään hakuehdot ahneesti mahdollisimman harvoiksi OR-kyselyiksi, jotka mahtuvat pituusrajaan
+    queries = []
+    packed: List[str] = []
+    for term in terms:
+        if packed and len(_or_query(packed + [term], suffix)) > max_length:
+            queries.append(_or_query(packed, suffix))
+            packed = []
+        
+        packed.append(term)
+    
+    if packed:
+        queries.append(_or_query(packed, suffix))
     
-    return await query_tweets(f"\"{search_word}\" lang:fi", start_date, end_date, session, bearer, included_tweets=False)
+    return queries
+
+def _or_query(terms: List[str], suffix: str) -> str:
+    return f"({' OR '.join(terms)}) {suffix}"
 
 async def query_tweets(
     query: str,
@@ -41,31 +90,40 @@ async def query_tweets(
     session: aiohttp.ClientSession,
     bearer: str,
     included_tweets=True,
+    since_id: Optional[str] = None,
+    writer: Optional[TweetWriter] = None,
 ) -> Tuple[dict, dict]:
     tweets = {}
     users = {}
 
-    for data in await _query_tweets(query, start_time, end_time, session, bearer):
-        for tweet in data.get("data", []):
-            tweets[tweet["id"]] = tweet
-
+    async for data in _iter_query_tweets(query, start_time, end_time, session, bearer, since_id=since_id):
+        page_tweets = data.get("data", [])
         if included_tweets:
-            for tweet in data.get("includes", {}).get("tweets", []):
-                tweets[tweet["id"]] = tweet
+            page_tweets = page_tweets + data.get("includes", {}).get("tweets", [])
+
+        page_users = data.get("includes", {}).get("users", [])
+
+        # Kirjoittajalle annetut sivut tallennetaan heti eikä niitä pidetä muistissa
+        if writer:
+            writer.write_page(page_tweets, page_users)
+            continue
+
+        for tweet in page_tweets:
+            tweets[tweet["id"]] = tweet
 
-        for user in data.get("includes", {}).get("users", []):
+        for user in page_users:
             users[user["id"]] = user
     
     return tweets, users
 
-async def _query_tweets(
+async def _iter_query_tweets(
     query: str,
     start_time: datetime.datetime,
     end_time: datetime.datetime,
     session: aiohttp.ClientSession,
     bearer: str,
-    next_token=None, print=print, count=0
-) -> List[dict]:
+    since_id=None
+) -> AsyncIterator[dict]:
     params = {
         "query": query,
         "tweet.fields": "created_at,public_metrics,author_id,in_reply_to_user_id,referenced_tweets",
@@ -74,48 +132,37 @@ async def _query_tweets(
         "start_time": start_time.astimezone().isoformat(),
         "end_time": end_time.astimezone().isoformat(),
     }
-    if next_token:
-        params["next_token"] = next_token
     
-    async with twitter_lock:
+    if since_id:
+        # since_id korvaa alkuajan: haetaan vain edellisen skreippauksen jälkeen julkaistut tviitit
+        params["since_id"] = since_id
+        del params["start_time"]
     
-        res = await session.get("https://api.twitter.com/2/tweets/search/all", params=params, headers={"Authorization": f"Bearer {bearer}"})
-        await asyncio.sleep(3.1)
-        if res:
-            while res.status == 503:
-                logger.info(f"Twitter error 503 - Retrying...")
-                res = await session.get("https://api.twitter.com/2/tweets/search/all", params=params, headers={"Authorization": f"Bearer {bearer}"})
+    count = 0
+    while True:
+        async with twitter_lock:
+            try:
+                async with client.request(session, "GET", "https://api.twitter.com/2/tweets/search/all", "twitter", retries=5, params=params, headers={"Authorization": f"Bearer {bearer}"}) as res:
+                    if res.status != 200:
+                        logger.info(await res.text())
+                        raise TwitterQueryError(f"Twitter error {res.status}")
+                    
+                    results = await res.json()
+            
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                raise TwitterQueryError(f"Twitter query failed: {query}") from ex
+            
+            finally:
                 await asyncio.sleep(3.1)
             
-            if res.status != 200:
-                logger.error(f"Twitter error {res.status}")
-                logger.info(res.content)
-                return []
+        if "meta" not in results:
+            raise TwitterQueryError(f"Illegal Twitter response: {results}")
         
-        else:
-            logger.warning("Returning [] from twitter query due to errors...")
-            return []
-        
-    results = await res.json()
-    if "meta" not in results:
-        logger.error(f"Illegal Twitter response: {res.content}")
-        return []
-    
-    if "next_token" in results["meta"]:
-        logger.info(f"Pagination required... {count+results['meta'].get('result_count', 0)}")
-        return [results] + await _query_tweets(query, start_time, end_time, session, bearer, next_token=results["meta"]["next_token"], count=count+results["meta"].get("result_count", 0))
-    
-    return [results]
+        yield results
 
-async def retry_get(session: aiohttp.ClientSession, retry_times: int, *args, **kwargs):
-    try:
-        return await session.get(*args, **kwargs)
-    
-    except:
-        logger.warning("Error during querying twitter", exc_info=sys.exc_info())
-        if retry_times > 0:
-            logger.info("Retrying...")
-            return retry_get(session, retry_times - 1, *args, **kwargs)
+        if "next_token" not in results["meta"]:
+            return
         
-        else:
-            return None
\ No newline at end of file
+        count += results["meta"].get("result_count", 0)
+        logger.info(f"Pagination required... {count}")
+        params["next_token"] = results["meta"]["next_token"]
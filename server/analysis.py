@@ -3,7 +3,7 @@ from collections import defaultdict
 import json
 import re
 import os
-from server.tweet_db import TweetDatabase, load_tweet_database
+from server.tweet_db import EDGE_TYPES, TweetDatabase, load_tweet_database
 from typing import Dict, List, NamedTuple
 
 import numpy as np
@@ -27,19 +27,23 @@ def _identify_media(url):
     
     return "tuntematon"
 
+# CSV-muotoisissa tuloksissa listat ovat merkkijonoja, artikkelivarastosta kootuissa valmiiksi listoja
+def _literal(value):
+    return ast.literal_eval(value) if isinstance(value, str) else value
+
 def _preprocess_data(data: pd.DataFrame) -> pd.DataFrame:
     data["date_modified"] = pd.to_datetime(data["date_modified"], utc=True).dt.tz_convert("Europe/Helsinki")
     if "content" in data:
         data["content"] = data["content"].map(str)
         data["n_words"] = data["content"].str.split(r"\s+").map(len)
-        data["n_persons"] = data["persons"].map(len)
+        data["n_persons"] = data["persons"].map(_literal).map(len)
     
     if "entities" in data:
-        data["entities"] = data["entities"].map(ast.literal_eval)
+        data["entities"] = data["entities"].map(_literal)
     
     if "tweets" in data:
-        data["tweets"] = data["tweets"].map(ast.literal_eval)
-        data["tweet_sentiments"] = data["tweet_sentiments"].map(ast.literal_eval)
+        data["tweets"] = data["tweets"].map(_literal)
+        data["tweet_sentiments"] = data["tweet_sentiments"].map(_literal)
         data["tweet_sentiment_avg"] = data["tweet_sentiments"].map(np.mean)
         data["tweet_sentiment_sum"] = data["tweet_sentiments"].map(np.sum)
         data["tweet_sentiment_abs_sum"] = data["tweet_sentiments"].map(lambda s: np.sum(np.abs(s)))
@@ -121,8 +125,78 @@ def twitter_count_matches(data: TweetDatabase, params: MultiDictProxy[str]) -> p
     
     return df[["created_at"]+keys]
 
+def _edge_type(params: MultiDictProxy[str]) -> str:
+    type = params.get("type", "replied_to")
+    if type not in EDGE_TYPES:
+        raise web.HTTPBadRequest(reason="Illegal type parameter value")
+    
+    return type
+
+def twitter_top_repliers(data: TweetDatabase, params: MultiDictProxy[str]) -> pd.DataFrame:
+    type = _edge_type(params)
+    counts = np.bincount(data.graph.indices[type], minlength=len(data.graph.usernames))
+    df = pd.DataFrame({"username": data.graph.usernames, "count": counts})
+    return df.sort_values("count", ascending=False).head(int(params.get("n", 100)))
+
+def twitter_reply_like_ratio(data: TweetDatabase, params: MultiDictProxy[str]) -> pd.DataFrame:
+    replies = data.graph.degrees("replied_to")
+    likes = data.like_count
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = replies / likes
+    
+    ratios = ratios[np.isfinite(ratios)]
+    counts, edges = np.histogram(ratios, bins=int(params.get("bins", 20)))
+    return pd.DataFrame({"bin_start": edges[:-1], "bin_end": edges[1:], "count": counts})
+
+def twitter_interaction_matrix(data: TweetDatabase, params: MultiDictProxy[str]) -> pd.DataFrame:
+    type = _edge_type(params)
+    edges = data.graph.edges(type)
+    edges = pd.DataFrame({
+        "user": np.array(data.graph.usernames, dtype=object)[edges["user"].values],
+        "author": np.array(data.usernames, dtype=object)[data.author[edges["tweet"].values]],
+    })
+    accounts = params.getall("accounts", [])
+    if accounts:
+        edges = edges[edges.user.isin(accounts) & edges.author.isin(accounts)]
+    
+    else:
+        n = int(params.get("n", 50))
+        top = pd.concat([edges.user, edges.author]).value_counts().index[:n]
+        edges = edges[edges.user.isin(top) & edges.author.isin(top)]
+    
+    return pd.crosstab(edges.user, edges.author)
+
+def _tag_counts(tags: pd.DataFrame, column: str, params: MultiDictProxy[str]) -> pd.DataFrame:
+    counts = tags["tag"].value_counts().head(int(params.get("n", 100)))
+    return pd.DataFrame({column: counts.index.astype(str), "count": counts.values})
+
+def twitter_top_mentions(data: TweetDatabase, params: MultiDictProxy[str]) -> pd.DataFrame:
+    return _tag_counts(data.mentions, "mention", params)
+
+def twitter_top_hashtags(data: TweetDatabase, params: MultiDictProxy[str]) -> pd.DataFrame:
+    return _tag_counts(data.hashtags, "hashtag", params)
+
+def twitter_hashtag_timeseries(data: TweetDatabase, params: MultiDictProxy[str]) -> pd.DataFrame:
+    hashtags = data.hashtags
+    selected = params.getall("hashtag", [])
+    if not selected:
+        selected = hashtags["tag"].value_counts().index[:int(params.get("n", 10))]
+    
+    hashtags = hashtags[hashtags.tag.isin(selected)]
+    df = pd.DataFrame({
+        "date": pd.to_datetime(data.created_at[hashtags.tweet.values], utc=True).tz_convert("Europe/Helsinki"),
+        "hashtag": hashtags.tag.astype(str).values,
+    })
+    return df.groupby([pd.Grouper(key="date", freq=params.get("freq", "1D")), "hashtag"]).size().unstack(fill_value=0)
+
 TWITTER_METHODS = {
     "count_matches": twitter_count_matches,
+    "top_repliers": twitter_top_repliers,
+    "reply_like_ratio": twitter_reply_like_ratio,
+    "interaction_matrix": twitter_interaction_matrix,
+    "top_mentions": twitter_top_mentions,
+    "top_hashtags": twitter_top_hashtags,
+    "hashtag_timeseries": twitter_hashtag_timeseries,
 }
 
 def analyze_tweets(method: str, params: MultiDictProxy[str]) -> pd.DataFrame:
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import re
+from typing import Any, Dict, List, Optional, Union
+
+import databases
+import pandas as pd
+
+# Artikkelien yhteinen tietovarasto. Jokainen artikkeli tallennetaan kerran osoitteen perusteella, ja sen sarakkeet
+# (sisältö, jäsennys, entiteetit, tviitit jne.) yhdistetään aiemmin tallennettuihin, joten eri toimeksiannot voivat
+# täydentää samaa artikkelia. Toimeksiannon tulos (resources-taulu) on vain lista artikkelien tunnisteita, sarakkeet ja
+# haun parametrit; taulukko kootaan vasta, kun tulosta pyydetään.
+
+# Sarake, joka kertoo rivin sarakkeet, joita toimeksianto ei saanut laskettua (työvaihe epäonnistui tai ohitettiin).
+# Niiden oletusarvot tallennetaan vain uusille artikkeleille eivätkä ne korvaa aiempia tuloksia.
+INCOMPLETE_COLUMN = "incomplete_columns"
+
+# Kielenkäsittelyn tulokset tallennetaan artikkelin normalisoidun tekstin tiivisteen perusteella, joten samasta
+# tekstistä eri osoitteissa (esim. IS:n ja HS:n yhteiset jutut tai päivitetyt Ylen jutut) ajetaan jäsennys, NER, Annif
+# ja sentimentti vain kerran. Osoitteiden tiivisteet tallennetaan content_hashes-tauluun aina, kun artikkelin sisältö
+# haetaan tai poimitaan uudelleen.
+def content_hash(content: str) -> str:
+    text = content.replace("\r\n", "\n").replace("\xad", "")
+    text = re.sub(r"[ \t]+", " ", text)
+    text = "\n".join(line.strip() for line in text.split("\n"))
+    text = re.sub(r"\n\n\n+", "\n\n", text).strip()
+    return "sha256:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+async def save_content_hash(db: databases.Database, url: str, content: str) -> str:
+    digest = content_hash(content)
+    await db.execute("""
+    INSERT OR REPLACE INTO content_hashes (url, hash, date) VALUES (:url, :hash, datetime('now'));
+    """, {"url": url, "hash": digest})
+    return digest
+
+async def load_content_hash(db: databases.Database, url: str) -> Optional[str]:
+    row = await db.fetch_one("SELECT hash FROM content_hashes WHERE url = :url;", {"url": url})
+    return row["hash"] if row else None
+
+# Päivittää tallennetun artikkelin sarakkeet (esim. uudelleen poimitun sisällön). Artikkelia ei lisätä, jos sitä ei ole.
+async def update_article(db: databases.Database, url: str, columns: Dict[str, Any]):
+    await db.execute("""
+    UPDATE articles SET content = json_patch(content, :patch), date = datetime('now') WHERE url = :url;
+    """, {"url": url, "patch": json.dumps(columns)})
+
+async def save_articles(db: databases.Database, df: pd.DataFrame) -> List[int]:
+    # Sama muunnos kuin välituloksissa: päivämäärät ISO-muotoon ja puuttuvat arvot null-arvoiksi
+    records: List[Dict[str, Any]] = json.loads(df.to_json(orient="records", date_format="iso", default_handler=str))
+    if not records:
+        return []
+
+    values = []
+    for record in records:
+        incomplete = set(record.pop(INCOMPLETE_COLUMN, None) or [])
+        # json_patch poistaa null-arvoiset avaimet, joten puuttuvat arvot jätetään pois päivityksestä
+        patch = {column: value for column, value in record.items() if value is not None and column not in incomplete}
+        values.append({"url": record["url"], "content": json.dumps(record), "patch": json.dumps(patch)})
+
+    # json_patch yhdistää lasketut sarakkeet vanhoihin yhdellä lauseella, joten rinnakkaiset toimeksiannot eivät
+    # kirjoita toistensa sarakkeiden yli
+    await db.execute_many("""
+    INSERT INTO articles (url, content, date) VALUES (:url, :content, datetime('now'))
+    ON CONFLICT (url) DO UPDATE SET content = json_patch(content, :patch), date = excluded.date;
+    """, values)
+
+    urls = [record["url"] for record in records]
+    rows = await db.fetch_all("""
+    SELECT id, url FROM articles WHERE url IN (SELECT value FROM json_each(:urls));
+    """, {"urls": json.dumps(urls)})
+    ids = {row["url"]: row["id"] for row in rows}
+    return [ids[url] for url in urls]
+
+async def load_articles(db: databases.Database, ids: List[int], columns: List[str]) -> pd.DataFrame:
+    rows = await db.fetch_all("""
+    SELECT id, content FROM articles WHERE id IN (SELECT value FROM json_each(:ids));
+    """, {"ids": json.dumps(ids)})
+    contents = {row["id"]: json.loads(row["content"]) for row in rows}
+    return pd.DataFrame([contents[i] for i in ids if i in contents], columns=columns)
+
+async def save_resource(db: databases.Database, resource_id: str, df: pd.DataFrame, query: Dict[str, Any]):
+    ids = await save_articles(db, df)
+    await db.execute("""
+    INSERT INTO resources (uuid, articles, columns, query, date) VALUES (:id, :articles, :columns, :query, datetime('now'));
+    """, {"id": resource_id, "articles": json.dumps(ids), "columns": json.dumps([column for column in df.columns if column != INCOMPLETE_COLUMN]), "query": json.dumps(query)})
+
+async def fetch_resource(db: databases.Database, resource_id: str) -> Any:
+    return await db.fetch_one("SELECT resource, articles, columns, date FROM resources WHERE uuid = :id;", {"id": resource_id})
+
+# Palauttaa tuloksen taulukkona. Ennen artikkelivarastoa tallennetut tulokset palautetaan sellaisenaan CSV-muodossa.
+async def load_resource(db: databases.Database, resource_id: str) -> Optional[Union[str, pd.DataFrame]]:
+    row = await fetch_resource(db, resource_id)
+    if not row:
+        return None
+
+    if row["articles"] is None:
+        return row["resource"]
+
+    return await load_articles(db, json.loads(row["articles"]), json.loads(row["columns"]))
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import re
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import urlparse
+
+from aiohttp import web
+from bs4 import BeautifulSoup
+from bs4.element import NavigableString
+
+from scrapers.extract import use_lxml
+from scrapers.fetch import COMPILED_SELECTORS, SELECTORS, FetchResult
+from scrapers.sanoma import _HS_SELECTORS, extract_article
+from server.config import load_config
+from server.snapshots import latest_snapshots, read_snapshot
+
+# Vertaa artikkelien poimintaa tallennetuilla sivuilla aiempaan BeautifulSoup-toteutukseen: mittaa nopeuden
+# sivustoittain ja tarkistaa, että poimittu teksti on täsmälleen sama.
+#
+#     python -m server.benchmark_extract --pages 200
+
+def reference_css_extract(url: str, html: str) -> FetchResult:
+    s = BeautifulSoup(html, "lxml")
+
+    article = ""
+    persons = []
+    for site in SELECTORS:
+        if re.fullmatch(site.url_regex, url):
+            texts = s.select(site.article)
+            if texts:
+                for text in texts:
+                    article += text.get_text() + "\n"
+
+            texts = s.select(site.persons)
+            if texts:
+                for text in texts:
+                    persons.append(text.get_text())
+
+            break
+
+    return FetchResult(content=article, persons=persons)
+
+def reference_parse_hs(html: str) -> FetchResult:
+    soup = BeautifulSoup(html, "lxml")
+
+    persons = soup.select(".article-personlink")
+    persons = [] if not persons else [p.get_text() for p in persons]
+
+    soup = soup.find("main") or soup
+    soup = soup.select_one("div#page-main-content + article") or soup.select_one("div#page-main-content") or soup
+    for elem in soup.find_all("aside"):
+        elem.extract()
+
+    for elem in soup.select("section.article-body + div, div.article-info, div.related-articles, div.article-actions, div.paywallWrapper"):
+        elem.extract()
+
+    for tag in ["h1", "h2", "h3", "h4", "h5", "h6", "h7", "p", "div"]:
+        for p in soup.find_all(tag):
+            p.insert_after(NavigableString("\n\n"))
+
+    text: str = soup.get_text().replace("\xad", "")
+    text = re.sub("\n\n+", "\n\n", text)
+
+    return FetchResult(content=text, persons=persons)
+
+def reference_extract(url: str, html: str) -> FetchResult:
+    if re.fullmatch(r"https?://www.hs.fi/.*", url):
+        return reference_parse_hs(html)
+
+    return reference_css_extract(url, html)
+
+def _time(extract: Callable[[str, str], FetchResult], pages: List[Tuple[str, str]]) -> Tuple[float, List[FetchResult]]:
+    start = time.perf_counter()
+    results = [extract(url, html) for url, html in pages]
+    return time.perf_counter() - start, results
+
+async def main(pages_per_site: int):
+    app = web.Application()
+    load_config(app)
+    db = app["db"]
+    await db.connect()
+    snapshots = await latest_snapshots(db)
+    await db.disconnect()
+
+    sites: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+    for url, digest in snapshots:
+        host = urlparse(url).hostname
+        if len(sites[host]) < pages_per_site:
+            sites[host].append((url, read_snapshot(app["SNAPSHOT_DIR"], digest)))
+
+    for host, pages in sorted(sites.items()):
+        if host == "www.hs.fi":
+            engine = "lxml" if use_lxml(_HS_SELECTORS) else "soupsieve"
+
+        elif host in COMPILED_SELECTORS:
+            site = COMPILED_SELECTORS[host]
+            engine = "lxml" if use_lxml([site.article, site.persons]) else "soupsieve"
+
+        else:
+            continue
+
+        reference_time, reference = _time(reference_extract, pages)
+        new_time, new = _time(extract_article, pages)
+        different = [url for (url, _), a, b in zip(pages, reference, new) if a != b]
+        print(f"{host}: {len(pages)} pages, {engine}, {1000*reference_time/len(pages):.1f} ms -> {1000*new_time/len(pages):.1f} ms per page, {len(different)} different")
+        for url in different[:10]:
+            print(f"    {url}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark article extraction on saved HTML snapshots")
+    parser.add_argument("--pages", type=int, default=100, help="number of pages per site")
+    args = parser.parse_args()
+    asyncio.run(main(args.pages))
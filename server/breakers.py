@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, MutableMapping, Optional, TypeVar
+
+import aiohttp
+
+from scrapers import client
+
+logger = logging.getLogger("breakers")
+
+T = TypeVar("T")
+
+# Taustapalveluiden (jäsennin, FiNER, Annif) katkaisijat. Kun palvelu epäonnistuu `failure_threshold` kertaa
+# peräkkäin, katkaisija aukeaa ja loput artikkelit ohittavat palvelun heti. Kun `reset_seconds` on kulunut, palvelun
+# tila tarkistetaan kevyellä pyynnöllä, ja jos palvelu vastaa, katkaisija suljetaan.
+
+PROBE_TIMEOUT = aiohttp.ClientTimeout(total=5)
+
+class SkippedStage(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name: str, url: str, failure_threshold: int, reset_seconds: float, deadline: float):
+        self.name = name
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.deadline = deadline
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.lock = asyncio.Lock()
+
+    def _cooling(self) -> bool:
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_seconds
+
+    async def allow(self, session: aiohttp.ClientSession) -> bool:
+        if self.opened_at is None:
+            return True
+
+        if self._cooling():
+            return False
+
+        # Vain yksi pyyntö kerrallaan tarkistaa palvelun tilan
+        async with self.lock:
+            if self.opened_at is None:
+                return True
+
+            if self._cooling():
+                return False
+
+            if await self.probe(session):
+                logger.info(f"{self.name} is up again, closing the circuit")
+                self.failures = 0
+                self.opened_at = None
+                return True
+
+            self.opened_at = time.monotonic()
+            return False
+
+    async def probe(self, session: aiohttp.ClientSession) -> bool:
+        try:
+            async with client.request(session, "GET", self.url, self.name, retries=0, timeout=PROBE_TIMEOUT) as response:
+                return response.status < 500
+
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def call(self, call: Callable[[], Awaitable[T]]) -> T:
+        try:
+            result = await asyncio.wait_for(call(), self.deadline)
+
+        except asyncio.CancelledError:
+            raise
+
+        except:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened_at is None:
+                logger.error(f"{self.name} failed {self.failures} times, skipping it for {self.reset_seconds} seconds")
+                self.opened_at = time.monotonic()
+
+            raise
+
+        self.failures = 0
+        return result
+
+# Toimeksiannon aikabudjetti taustapalveluille. Kun budjetti on käytetty, loput artikkelit ohittavat taustapalvelut.
+# Ohitetut työvaiheet ja artikkelien määrät kirjataan toimeksiannon tilaan.
+class TicketBudget:
+    def __init__(self, seconds: float):
+        self.deadline = time.monotonic() + seconds
+        self.skipped: Dict[str, int] = {}
+
+    def expired(self) -> bool:
+        return time.monotonic() > self.deadline
+
+    def skip(self, stage: str):
+        if stage not in self.skipped:
+            logger.warning(f"Skipping {stage} for the remaining articles")
+
+        self.skipped[stage] = self.skipped.get(stage, 0) + 1
+
+def create_breakers(app: MutableMapping) -> Dict[str, CircuitBreaker]:
+    return {
+        name: CircuitBreaker(name, app[url], app["BACKEND_FAILURES"], app["BACKEND_RESET"], app["BACKEND_DEADLINE"])
+        for name, url in [("parser", "PARSER_URL"), ("ner", "NER_URL"), ("annif", "ANNIF_URL")]
+    }
+
+async def call_backend(name: str, app: MutableMapping, session: aiohttp.ClientSession, budget: TicketBudget, call: Callable[[], Awaitable[T]]) -> T:
+    breaker: CircuitBreaker = app["breakers"][name]
+    if budget.expired() or not await breaker.allow(session):
+        budget.skip(name)
+        raise SkippedStage(name)
+
+    return await breaker.call(call)
@@ -0,0 +1,62 @@
+import io
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import databases
+import pandas as pd
+
+# Toimeksiannon työvaiheiden välitulokset. Jokaisen median jokainen valmis työvaihe (haku, sisältö, jäsennys,
+# NER, Annif, sentimentti, tviitit) tallennetaan, jotta keskeytynyt toimeksianto voidaan jatkaa viimeisestä
+# valmiista työvaiheesta. Kesken olevan työvaiheen valmiit artikkelit tallennetaan erikseen checkpoint_rows-tauluun
+# muutaman artikkelin välein, joten myöskään keskeytynyttä työvaihetta ei tarvitse aloittaa alusta.
+
+def _json_default(value: Any) -> Any:
+    # numpy-luvut
+    return value.item() if hasattr(value, "item") else str(value)
+
+class Checkpoints:
+    def __init__(self, db: databases.Database, ticket_id: str, media: str):
+        self.db = db
+        self.ticket_id = ticket_id
+        self.media = media
+
+    async def load(self, stage: str) -> Optional[pd.DataFrame]:
+        row = await self.db.fetch_one("""
+        SELECT content FROM checkpoints WHERE ticket_id = :ticket_id AND media = :media AND stage = :stage;
+        """, {"ticket_id": self.ticket_id, "media": self.media, "stage": stage})
+        if not row:
+            return None
+
+        return pd.read_json(io.StringIO(row["content"]), orient="split", dtype=False, convert_dates=False)
+
+    async def save(self, stage: str, df: pd.DataFrame, columns: Optional[List[str]] = None):
+        if columns is not None:
+            df = df[columns]
+
+        await self.db.execute("""
+        INSERT OR REPLACE INTO checkpoints (ticket_id, media, stage, content) VALUES (:ticket_id, :media, :stage, :content);
+        """, {"ticket_id": self.ticket_id, "media": self.media, "stage": stage, "content": df.to_json(orient="split", date_format="iso")})
+
+    # Palauttaa kesken olevan työvaiheen valmiiden artikkelien arvot osoitteen mukaan
+    async def load_rows(self, stage: str) -> Dict[str, Tuple]:
+        rows = await self.db.fetch_all("""
+        SELECT url, content FROM checkpoint_rows WHERE ticket_id = :ticket_id AND media = :media AND stage = :stage;
+        """, {"ticket_id": self.ticket_id, "media": self.media, "stage": stage})
+        return {row["url"]: tuple(json.loads(row["content"])) for row in rows}
+
+    async def save_rows(self, stage: str, rows: List[Tuple[str, Tuple]]):
+        await self.db.execute_many("""
+        INSERT OR REPLACE INTO checkpoint_rows (ticket_id, media, stage, url, content) VALUES (:ticket_id, :media, :stage, :url, :content);
+        """, [
+            {"ticket_id": self.ticket_id, "media": self.media, "stage": stage, "url": url, "content": json.dumps(values, default=_json_default)}
+            for url, values in rows
+        ])
+
+    async def delete_rows(self, stage: str):
+        await self.db.execute("""
+        DELETE FROM checkpoint_rows WHERE ticket_id = :ticket_id AND media = :media AND stage = :stage;
+        """, {"ticket_id": self.ticket_id, "media": self.media, "stage": stage})
+
+async def delete_checkpoints(db: databases.Database, ticket_id: str):
+    await db.execute("DELETE FROM checkpoints WHERE ticket_id = :ticket_id;", {"ticket_id": ticket_id})
+    await db.execute("DELETE FROM checkpoint_rows WHERE ticket_id = :ticket_id;", {"ticket_id": ticket_id})
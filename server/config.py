@@ -0,0 +1,39 @@
+import configparser
+from typing import MutableMapping
+
+import databases
+
+from server.breakers import create_breakers
+from server.singleflight import SingleFlight
+
+def load_config(app: MutableMapping, filename: str = "config.ini"):
+    parser = configparser.ConfigParser()
+    parser.read(filename)
+
+    app["db"] = databases.Database(parser["Scraper"].get("DatabaseURL", "sqlite://./database.db"))
+    app["PARSER_URL"] = parser["Parser"].get("URL", "http://localhost:15000")
+    app["PARSER_ENABLED"] = parser["Parser"].getboolean("Enabled")
+    app["NER_URL"] = parser["FiNER"].get("URL", "http://localhost:19992")
+    app["NER_ENABLED"] = parser["FiNER"].getboolean("Enabled")
+    app["TWITTER_BEARER"] = parser["twitter.com"].get("Bearer")
+    app["TWITTER_ENABLED"] = parser["twitter.com"].getboolean("Enabled")
+    app["TWITTER_METADATA"] = parser["twitter.com"].get("UserMetadata", None)
+    app["ANNIF_URL"] = parser["Annif"].get("URL", "http://127.0.0.1:5000/v1/projects/yle-2021-ensemble-fi/suggest")
+    app["ANNIF_ENABLED"] = parser["Annif"].getboolean("Enabled")
+    app["HS_USERNAME"] = parser["hs.fi"]["Username"]
+    app["HS_PASSWORD"] = parser["hs.fi"]["Password"]
+    app["HS_TABS"] = parser["hs.fi"].getint("Tabs", 4)
+    app["HS_COOKIES"] = parser["hs.fi"].get("CookieFile", "hs_cookies.json")
+    app["QUEUE_WORKERS"] = parser.getint("Queue", "Workers", fallback=1)
+    app["QUEUE_LEASE"] = parser.getint("Queue", "LeaseSeconds", fallback=120)
+    app["BACKEND_FAILURES"] = parser.getint("Backends", "FailureThreshold", fallback=3)
+    app["BACKEND_RESET"] = parser.getint("Backends", "ResetSeconds", fallback=60)
+    app["BACKEND_DEADLINE"] = parser.getint("Backends", "DeadlineSeconds", fallback=300)
+    app["BACKEND_BUDGET"] = parser.getint("Backends", "TicketBudgetSeconds", fallback=4*3600)
+    app["breakers"] = create_breakers(app)
+    app["singleflight"] = SingleFlight()
+    app["SNAPSHOT_DIR"] = parser.get("Snapshots", "Directory", fallback="snapshots")
+    app["SEARCH_CACHE_FINAL_DAYS"] = parser.getint("Search", "CacheFinalDays", fallback=7)
+    app["SEARCH_CACHE_TTL"] = parser.getint("Search", "CacheTTLSeconds", fallback=3600)
+    app["RESOURCE_CACHE_DIR"] = parser.get("Resources", "CacheDirectory", fallback="resource_cache")
+    app["RESOURCE_CACHE_BYTES"] = parser.getint("Resources", "CacheMaxMegabytes", fallback=2048) << 20
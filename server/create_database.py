@@ -1,27 +1,117 @@
 import sqlite3
 
+# Skriptin voi ajaa myös olemassa olevalle tietokannalle: puuttuvat taulut ja sarakkeet luodaan.
 db = sqlite3.connect("./database.db")
 cursor = db.cursor()
+
+def add_column(table: str, column: str, definition: str):
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table});")]
+    if columns and column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+
 cursor.execute("""
-CREATE TABLE tickets(
+CREATE TABLE IF NOT EXISTS tickets(
     uuid TEXT PRIMARY KEY,
     status TEXT,
     resource_id TEXT,
-    date DATETIME
+    date DATETIME,
+    kind TEXT,
+    params TEXT,
+    priority INTEGER DEFAULT 0,
+    claim TEXT,
+    worker TEXT,
+    lease_expires DATETIME,
+    skipped_stages TEXT
 );
 """)
+add_column("tickets", "kind", "TEXT")
+add_column("tickets", "params", "TEXT")
+add_column("tickets", "priority", "INTEGER DEFAULT 0")
+add_column("tickets", "claim", "TEXT")
+add_column("tickets", "worker", "TEXT")
+add_column("tickets", "lease_expires", "DATETIME")
+add_column("tickets", "skipped_stages", "TEXT")
+cursor.execute("""
+CREATE INDEX IF NOT EXISTS tickets_status ON tickets(status, priority);
+""")
 cursor.execute("""
-CREATE TABLE resources(
+CREATE TABLE IF NOT EXISTS resources(
     uuid TEXT PRIMARY KEY,
     resource TEXT,
+    date DATETIME,
+    articles TEXT,
+    columns TEXT,
+    query TEXT
+);
+""")
+add_column("resources", "articles", "TEXT")
+add_column("resources", "columns", "TEXT")
+add_column("resources", "query", "TEXT")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS articles(
+    id INTEGER PRIMARY KEY,
+    url TEXT UNIQUE,
+    content TEXT,
     date DATETIME
 );
 """)
 cursor.execute("""
-CREATE TABLE cache(
+CREATE TABLE IF NOT EXISTS cache(
     key TEXT PRIMARY KEY,
     content TEXT
 );
 """)
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS checkpoints(
+    ticket_id TEXT,
+    media TEXT,
+    stage TEXT,
+    content TEXT,
+    PRIMARY KEY (ticket_id, media, stage)
+);
+""")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS checkpoint_rows(
+    ticket_id TEXT,
+    media TEXT,
+    stage TEXT,
+    url TEXT,
+    content TEXT,
+    PRIMARY KEY (ticket_id, media, stage, url)
+);
+""")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS search_cache(
+    key TEXT PRIMARY KEY,
+    content TEXT,
+    final INTEGER,
+    date DATETIME
+);
+""")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS snapshots(
+    url TEXT,
+    date DATETIME,
+    hash TEXT,
+    PRIMARY KEY (url, date)
+);
+""")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS content_hashes(
+    url TEXT PRIMARY KEY,
+    hash TEXT,
+    date DATETIME
+);
+""")
+cursor.execute("""
+CREATE INDEX IF NOT EXISTS content_hashes_hash ON content_hashes(hash);
+""")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS scrape_state(
+    name TEXT PRIMARY KEY,
+    since_id TEXT,
+    collected_until DATETIME
+);
+""")
 db.commit()
-db.close()
\ No newline at end of file
+db.close()
@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+import logging
+import sys
+
+import databases
+from aiohttp import web
+
+from scrapers import query
+from server.scraping import start_scraping, start_scraping_twitter
+from server.ticket_queue import Job, claim_next, release, renew_lease
+
+logger = logging.getLogger("jobs")
+
+# Kuinka usein työntekijät tarkistavat jonon, vaikka uusista toimeksiannoista ei olisi ilmoitettu
+POLL_INTERVAL = 5
+
+async def _run_analyse(job: Job, app: web.Application):
+    params = job.params
+    query_params = query.Params(
+        query=params["query"],
+        from_date=datetime.date.fromisoformat(params["from_date"]),
+        to_date=datetime.date.fromisoformat(params["to_date"]) if params.get("to_date") else datetime.date.today(),
+        enabled=params["enabled"],
+        extra=params.get("params", {})
+    )
+    await start_scraping(query_params, params["media"], job.ticket_id, job.claim, app)
+
+async def _run_scrape_twitter(job: Job, app: web.Application):
+    params = job.params
+    from_date = datetime.datetime.fromisoformat(params["from_date"])
+    to_date = datetime.datetime.fromisoformat(params["to_date"])
+    await start_scraping_twitter(params["accounts"], from_date, to_date, job.ticket_id, job.claim, app)
+
+JOB_HANDLERS = {
+    "analyse": _run_analyse,
+    "scrape_twitter": _run_scrape_twitter,
+}
+
+async def run_job(job: Job, app: web.Application):
+    db: databases.Database = app["db"]
+    if job.kind not in JOB_HANDLERS:
+        logger.error(f"Unknown job kind {job.kind} for ticket {job.ticket_id}")
+        await db.execute("""UPDATE tickets SET status = 'error' WHERE uuid = :id AND claim = :claim;""", {"id": job.ticket_id, "claim": job.claim})
+        return
+    
+    task = asyncio.create_task(JOB_HANDLERS[job.kind](job, app), name=f"job {job.ticket_id}")
+    heartbeat = asyncio.create_task(_heartbeat(job, task, app), name=f"heartbeat {job.ticket_id}")
+    try:
+        await task
+        await release(db, job)
+    
+    except asyncio.CancelledError:
+        # Jos työntekijä sammutetaan kesken toimeksiannon, varaus jätetään vanhenemaan, jolloin toinen
+        # työntekijä jatkaa toimeksiantoa
+        if not heartbeat.done():
+            raise
+        
+        logger.warning(f"Job {job.ticket_id} was cancelled")
+    
+    except:
+        logger.error(f"Error during job {job.ticket_id}", exc_info=sys.exc_info())
+        await db.execute("""UPDATE tickets SET status = 'error' WHERE uuid = :id AND claim = :claim;""", {"id": job.ticket_id, "claim": job.claim})
+        await release(db, job)
+    
+    finally:
+        heartbeat.cancel()
+
+async def _heartbeat(job: Job, task: asyncio.Task, app: web.Application):
+    lease = app["QUEUE_LEASE"]
+    while True:
+        await asyncio.sleep(lease / 3)
+        try:
+            if not await renew_lease(app["db"], job, lease):
+                logger.error(f"Lost the lease of job {job.ticket_id}, cancelling")
+                task.cancel()
+                return
+        
+        except:
+            logger.warning(f"Failed to renew the lease of job {job.ticket_id}", exc_info=sys.exc_info())
+
+async def worker(app: web.Application, n: int):
+    db: databases.Database = app["db"]
+    event: asyncio.Event = app["job_event"]
+    logger.info(f"Worker {n} started")
+    while True:
+        event.clear()
+        job = await claim_next(db, app["QUEUE_LEASE"])
+        if not job:
+            try:
+                await asyncio.wait_for(event.wait(), POLL_INTERVAL)
+            
+            except asyncio.TimeoutError:
+                pass
+            
+            continue
+        
+        logger.info(f"Worker {n} running {job.kind} ticket {job.ticket_id}")
+        await run_job(job, app)
+
+async def start_workers(app: web.Application):
+    app["job_event"] = asyncio.Event()
+    app["workers"] = [asyncio.create_task(worker(app, n), name=f"worker {n}") for n in range(app["QUEUE_WORKERS"])]
+
+async def stop_workers(app: web.Application):
+    for task in app.get("workers", []):
+        task.cancel()
+    
+    await asyncio.gather(*app.get("workers", []), return_exceptions=True)
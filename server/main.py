@@ -1,10 +1,8 @@
 import asyncio
-import configparser
 import datetime
 import io
 import logging
 import re
-import uuid
 from typing import Any
 import json
 
@@ -12,11 +10,14 @@ import databases
 import matplotlib.pyplot as plt
 import pandas as pd
 from aiohttp import web
-from scrapers import query
 
+from scrapers import client
 from server.analysis import analyze, analyze_tweets
-from server.scraping import start_scraping, start_scraping_twitter
+from server.articles import fetch_resource, load_resource
+from server.config import load_config
+from server.streaming import resource_columns, send_resource
 import server.scheduler as scheduler
+import server.ticket_queue as ticket_queue
 
 logging.basicConfig(filename='server.log', level=logging.INFO)
 
@@ -51,16 +52,15 @@ async def scrape_twitter(request: web.Request):
         logging.warning(f"Malformed dates: {params['from_date']}, {params['to_date']}")
         raise web.HTTPBadRequest()
 
-    ticket_id = str(uuid.uuid4())
     db: databases.Database = request.app["db"]
-    await db.execute("INSERT INTO tickets(uuid, status, date) VALUES (:id, :status, datetime('now'));", {"id": ticket_id, "status": "in progress"})
+    ticket_id = await ticket_queue.enqueue(db, "scrape_twitter", {
+        "accounts": params["accounts"],
+        "from_date": from_date.isoformat(),
+        "to_date": to_date.isoformat(),
+    }, priority=_priority(params))
+    ticket_queue.notify(request.app)
 
-    response = web.json_response({"status": "ok", "message": "Scrape scheluded!", "ticket_id": ticket_id})
-    await response.prepare(request)
-    await response.write_eof()
-
-    asyncio.create_task(start_scraping_twitter(params["accounts"], from_date, to_date, ticket_id, request.app), name="scraper")
-    return response
+    return web.json_response({"status": "ok", "message": "Scrape scheluded!", "ticket_id": ticket_id})
 
 @routes.post("/scrape")
 @routes.post("/analyse")
@@ -88,45 +88,61 @@ async def scrape(request: web.Request):
     if not isinstance(params["enabled"], list):
         raise web.HTTPBadRequest(reason="enabled is not a list")
     
-    query_params = query.Params(
-        query=params["query"],
-        from_date=datetime.date.fromisoformat(params["from_date"]),
-        to_date=datetime.date.fromisoformat(params.get("to_date", None)),
-        enabled=params["enabled"],
-        extra=params.get("params", {})
-    )
-    media = params["media"]
+    try:
+        datetime.date.fromisoformat(params["from_date"])
+        if "to_date" in params:
+            datetime.date.fromisoformat(params["to_date"])
+    
+    except ValueError:
+        raise web.HTTPBadRequest(reason="Malformed date")
 
-    ticket_id = str(uuid.uuid4())
     db: databases.Database = request.app["db"]
-    await db.execute("INSERT INTO tickets(uuid, status, date) VALUES (:id, :status, datetime('now'));", {"id": ticket_id, "status": "in progress"})
+    ticket_id = await ticket_queue.enqueue(db, "analyse", {
+        key: params[key] for key in ["query", "from_date", "to_date", "media", "enabled", "params"] if key in params
+    }, priority=_priority(params))
+    ticket_queue.notify(request.app)
 
-    response = web.json_response({"status": "ok", "message": "Scrape scheluded!", "ticket_id": ticket_id})
-    await response.prepare(request)
-    await response.write_eof()
+    return web.json_response({"status": "ok", "message": "Scrape scheluded!", "ticket_id": ticket_id})
 
-    asyncio.create_task(start_scraping(query_params, media, ticket_id, request.app), name="scraper")
-    return response
+def _priority(params: dict) -> int:
+    priority = params.get("priority", 0)
+    if not isinstance(priority, int):
+        raise web.HTTPBadRequest(reason="priority is not an integer")
+    
+    return priority
 
 @routes.get("/ticket/{uuid}")
 async def get_ticket(request: web.Request):
     ticket_id = request.match_info["uuid"]
     db: databases.Database = request.app["db"]
-    row = await db.fetch_one("SELECT status, resource_id FROM tickets WHERE uuid = :id;", {"id": ticket_id})
+    row = await db.fetch_one("SELECT status, resource_id, skipped_stages FROM tickets WHERE uuid = :id;", {"id": ticket_id})
     if not row:
         raise web.HTTPNotFound()
     
-    return web.json_response({"status": row["status"], "resource_id": row["resource_id"], "ticket_id": ticket_id})
+    return web.json_response({
+        "status": row["status"],
+        "resource_id": row["resource_id"],
+        "ticket_id": ticket_id,
+        "queue_position": await ticket_queue.queue_position(db, ticket_id),
+        "skipped_stages": json.loads(row["skipped_stages"]) if row["skipped_stages"] else {},
+    })
 
 @routes.get("/resource/{uuid}")
 async def get_resource(request: web.Request):
     resource_id = request.match_info["uuid"]
     db: databases.Database = request.app["db"]
-    row = await db.fetch_one("SELECT resource FROM resources WHERE uuid = :id;", {"id": resource_id})
+    row = await fetch_resource(db, resource_id)
     if not row:
         raise web.HTTPNotFound()
     
-    return web.Response(body=row["resource"])
+    columns = None
+    if "columns" in request.query:
+        columns = request.query["columns"].split(",")
+        unknown = set(columns) - set(resource_columns(row))
+        if unknown:
+            raise web.HTTPBadRequest(reason="Unknown columns: " + ", ".join(sorted(unknown)))
+    
+    return await send_resource(request, resource_id, row, columns)
 
 @routes.get("/resource/{uuid}/analysis/{method}")
 async def analysis(request: web.Request):
@@ -138,11 +154,11 @@ async def analysis(request: web.Request):
     
     else:
         db: databases.Database = request.app["db"]
-        row = await db.fetch_one("SELECT resource FROM resources WHERE uuid = :id;", {"id": resource_id})
-        if not row:
+        resource = await load_resource(db, resource_id)
+        if resource is None:
             raise web.HTTPNotFound()
         
-        data: Any = pd.read_csv(io.StringIO(row["resource"]))
+        data: Any = pd.read_csv(io.StringIO(resource)) if isinstance(resource, str) else resource
         response = analyze(data, method, request.query)
 
     if request.query.get("index", None):
@@ -230,26 +246,21 @@ async def run_daily_schedule(request: web.Request):
     return web.Response(status=200)
 
 async def init_app():
-    parser = configparser.ConfigParser()
-    parser.read("config.ini")
-
-    db = databases.Database(parser["Scraper"].get("DatabaseURL", "sqlite://./database.db"))
-    await db.execute("UPDATE tickets SET status = 'interrupted' WHERE status = 'in progress';")
     app = web.Application()
-    app["db"] = db
-    app["PARSER_URL"] = parser["Parser"].get("URL", "http://localhost:15000")
-    app["PARSER_ENABLED"] = parser["Parser"].getboolean("Enabled")
-    app["NER_URL"] = parser["FiNER"].get("URL", "http://localhost:19992")
-    app["NER_ENABLED"] = parser["FiNER"].getboolean("Enabled")
-    app["TWITTER_BEARER"] = parser["twitter.com"].get("Bearer")
-    app["TWITTER_ENABLED"] = parser["twitter.com"].getboolean("Enabled")
-    app["TWITTER_METADATA"] = parser["twitter.com"].get("UserMetadata", None)
-    app["ANNIF_URL"] = parser["Annif"].get("URL", "http://127.0.0.1:5000/v1/projects/yle-2021-ensemble-fi/suggest")
-    app["ANNIF_ENABLED"] = parser["Annif"].getboolean("Enabled")
-    app["HS_USERNAME"] = parser["hs.fi"]["Username"]
-    app["HS_PASSWORD"] = parser["hs.fi"]["Password"]
+    load_config(app)
+
+    await ticket_queue.recover(app["db"])
     
+    app.cleanup_ctx.append(client.client_session)
     app.add_routes(routes)
+    if app["QUEUE_WORKERS"] > 0:
+        # Työntekijät voi ajaa myös erillisinä prosesseina (python -m server.worker), jolloin palvelin vain
+        # vastaanottaa toimeksiannot eikä lataa skreippaus- ja analyysimalleja
+        import server.jobs as jobs
+        app.on_startup.append(jobs.start_workers)
+        app.on_cleanup.append(jobs.stop_workers)
+
     return app
 
-web.run_app(init_app())
+if __name__ == "__main__":
+    web.run_app(init_app())
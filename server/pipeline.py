@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import sys
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger("pipeline")
+
+# Artikkelikohtainen liukuhihna: jokainen artikkeli etenee työvaiheesta seuraavaan heti, kun sen syöte on valmis,
+# eikä työvaiheiden välillä odoteta koko aineiston valmistumista. Jokaisella työvaiheella on oma rinnakkaisuusrajansa
+# ja rajattu jono, joten hidas työvaihe hidastaa syötettä (backpressure) eikä muisti kasva rajatta.
+
+class Item(NamedTuple):
+    index: Any
+    row: Dict[str, Any]
+
+class Stage(NamedTuple):
+    name: str
+    columns: List[str]
+    # Palauttaa arvot työvaiheen sarakkeille samassa järjestyksessä. Arvot lisätään myös riviin seuraavia
+    # työvaiheita varten.
+    process: Callable[[Item], Awaitable[Tuple]]
+    default: Tuple
+    concurrency: int = 1
+    # Työvaihe, jonka tuloksia tämä työvaihe tarvitsee; None tarkoittaa, että artikkelit tulevat suoraan syötteestä
+    after: Optional[str] = None
+
+class Pipeline:
+    def __init__(self, stages: List[Stage], queue_size: int = 4):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.results: Dict[str, Dict[Any, Tuple]] = {stage.name: {} for stage in stages}
+        self.queues: Dict[str, asyncio.Queue] = {}
+
+    def _children(self, name: Optional[str]) -> List[Stage]:
+        return [stage for stage in self.stages if stage.after == name]
+
+    async def _worker(self, stage: Stage):
+        queue = self.queues[stage.name]
+        while True:
+            item: Item = await queue.get()
+            try:
+                try:
+                    values = await stage.process(item)
+
+                # CancelledError ei ole Exception, joten peruttu työntekijä lopettaa kesken käsittelyn
+                except Exception:
+                    logger.error(f"Error in stage {stage.name} for {item.row.get('url')}", exc_info=sys.exc_info())
+                    values = stage.default
+
+                self.results[stage.name][item.index] = values
+                row = dict(item.row)
+                row.update(zip(stage.columns, values))
+                for child in self._children(stage.name):
+                    await self.queues[child.name].put(Item(item.index, row))
+
+            finally:
+                queue.task_done()
+
+    async def run(self, items: AsyncIterable[Item]) -> Dict[str, Dict[Any, Tuple]]:
+        workers = []
+        for stage in self.stages:
+            self.queues[stage.name] = asyncio.Queue(self.queue_size * stage.concurrency)
+            workers += [asyncio.create_task(self._worker(stage), name=f"{stage.name} {i}") for i in range(stage.concurrency)]
+
+        try:
+            roots = self._children(None)
+            async for item in items:
+                for stage in roots:
+                    await self.queues[stage.name].put(item)
+
+            # Jonot tyhjennetään siinä järjestyksessä, jossa artikkelit kulkevat työvaiheiden läpi
+            done = {None}
+            while len(done) <= len(self.stages):
+                ready = [stage for stage in self.stages if stage.name not in done and stage.after in done]
+                if not ready:
+                    raise ValueError(f"Unknown stage dependencies in {[stage.after for stage in self.stages]}")
+
+                await asyncio.gather(*(self.queues[stage.name].join() for stage in ready))
+                done.update(stage.name for stage in ready)
+
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        return self.results
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import re
+import sys
+from typing import Optional, Tuple
+
+from aiohttp import web
+
+from scrapers.fetch import FetchResult
+from scrapers.sanoma import extract_article
+from server.articles import save_content_hash, update_article
+from server.config import load_config
+from server.snapshots import latest_snapshots, read_snapshot
+
+# Poimii artikkelit uudelleen tallennetusta raaka-HTML:stä ja päivittää scrape_cache-välimuistin, tekstien tiivisteet
+# ja artikkelivarastoon tallennettujen artikkelien sisällön. Kielenkäsittelyn sarakkeet lasketaan uudesta tekstistä,
+# kun artikkeli seuraavan kerran kuuluu toimeksiantoon. Ajetaan, kun sivuston valitsimia (fetch.SELECTORS tai
+# sanoma.parse_hs) on muutettu:
+#
+#     python -m server.reextract --processes 4 --url "https://yle.fi/.*"
+
+logging.basicConfig(filename='reextract.log', level=logging.INFO)
+logger = logging.getLogger("reextract")
+
+def _reextract(directory: str, url: str, digest: str) -> Tuple[str, Optional[str]]:
+    try:
+        return url, extract_article(url, read_snapshot(directory, digest)).to_json()
+
+    except:
+        logger.error(f"Failed to re-extract {url}", exc_info=sys.exc_info())
+        return url, None
+
+async def main(processes: Optional[int], url_regex: Optional[str]):
+    app = web.Application()
+    load_config(app)
+    db = app["db"]
+    directory = app["SNAPSHOT_DIR"]
+    await db.connect()
+
+    snapshots = await latest_snapshots(db)
+    if url_regex:
+        snapshots = [(url, digest) for url, digest in snapshots if re.fullmatch(url_regex, url)]
+
+    logger.info(f"Re-extracting {len(snapshots)} articles")
+    loop = asyncio.get_event_loop()
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = [loop.run_in_executor(pool, _reextract, directory, url, digest) for url, digest in snapshots]
+        for i, future in enumerate(asyncio.as_completed(futures)):
+            url, content = await future
+            if content is None:
+                continue
+
+            await db.execute("""
+            INSERT OR REPLACE INTO cache (key, content) VALUES (:key, :content);
+            """, {"key": "scrape_cache " + url, "content": content})
+
+            result = FetchResult.from_json(content)
+            if result.content:
+                await save_content_hash(db, url, result.content)
+                await update_article(db, url, {"content": result.content, "persons": result.persons})
+
+            if (i+1) % 1000 == 0:
+                logger.info(f"{i+1}/{len(snapshots)} articles re-extracted")
+
+    logger.info("Re-extraction finished")
+    await db.disconnect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the article cache from saved HTML snapshots")
+    parser.add_argument("--processes", type=int, default=None, help="number of extraction processes (default: number of CPUs)")
+    parser.add_argument("--url", default=None, help="only re-extract articles whose URL matches this regular expression")
+    args = parser.parse_args()
+    asyncio.run(main(args.processes, args.url))
@@ -1,17 +1,35 @@
+import asyncio
 import configparser
 import datetime
-import json
 import logging
+import os
 import sys
-from typing import List, Union
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
 
 import aiohttp
+import databases
 from aiohttp import web
 
-from scrapers import twitter
+from scrapers import tweet_store, twitter
 
 logger = logging.getLogger("scheduler")
 
+class ScrapeState(NamedTuple):
+    since_id: Optional[str]
+    collected_until: datetime.datetime
+
+async def load_state(name: str, db: databases.Database) -> Optional[ScrapeState]:
+    row = await db.fetch_one("SELECT since_id, collected_until FROM scrape_state WHERE name = :name;", {"name": name})
+    if not row:
+        return None
+    
+    return ScrapeState(row["since_id"], datetime.datetime.fromisoformat(row["collected_until"]))
+
+async def save_state(name: str, state: ScrapeState, db: databases.Database):
+    await db.execute("""
+    INSERT OR REPLACE INTO scrape_state (name, since_id, collected_until) VALUES (:name, :since_id, :collected_until);
+    """, {"name": name, "since_id": state.since_id, "collected_until": state.collected_until.isoformat()})
+
 class DailyTwitterScrape:
     def __init__(self, name: str, interval: datetime.timedelta, accounts: List[str] = [], search_words: List[str] = []):
         self.name = name
@@ -19,43 +37,62 @@ class DailyTwitterScrape:
         self.accounts = accounts
         self.search_words = search_words
     
-    async def scrape(self, session: aiohttp.ClientSession, bearer: str):
+    async def scrape(self, session: aiohttp.ClientSession, bearer: str, db: databases.Database):
         today = datetime.date.today()
-        date_from = datetime.datetime.combine(today - self.interval, datetime.time(hour=0, minute=0))
-        date_to = date_from + datetime.timedelta(days=1)
-        tweets = {}
-        users = {}
-        l = len(self.accounts)
-        for i in range(0, l, 10):
-            logger.info(f"{i}/{l} Loading tweets from {', '.join(self.accounts[i:i+10])}")
-            user_tweets, user_users = await twitter.query_by_username(self.accounts[i:i+10], date_from, date_to, session, bearer)
-            tweets.update(user_tweets)
-            users.update(user_users)
-
-        for search_word in self.search_words:
-            logger.info(f"Loading tweets with {repr(search_word)}")
-            search_tweets, search_users = await twitter.query_by_search_word(search_word, date_from, date_to, session, bearer)
-            tweets.update(search_tweets)
-            users.update(search_users)
-        
-        filename = f"tweets/{self.name}-{today.isoformat()}.json"
-        with open(filename, "w") as f:
-            json.dump({"users": users, "tweets": tweets}, f)
+        date_to = datetime.datetime.combine(today - self.interval, datetime.time(hour=0, minute=0)) + datetime.timedelta(days=1)
+        date_from = date_to - datetime.timedelta(days=1)
+        since_id = None
+
+        # Jatketaan siitä, mihin edellinen ajo jäi, jotta päällekkäisiä aikavälejä ei haeta uudestaan. Väliin
+        # jääneet päivät haetaan korkeintaan intervallin verran taaksepäin.
+        state = await load_state(self.name, db)
+        if state:
+            if state.collected_until >= date_to:
+                logger.info(f"{self.name}: Already collected until {state.collected_until.isoformat()}")
+                return False
+            
+            date_from = max(state.collected_until, date_to - self.interval)
+            if state.collected_until >= date_from:
+                since_id = state.since_id
+
+        # Jos jokin kysely epäonnistuu, twitter.TwitterQueryError keskeyttää ajon ennen tilan tallentamista, joten
+        # seuraava ajo hakee saman aikavälin uudelleen
+        filename = f"tweets/{self.name}-{today.isoformat()}{tweet_store.default_extension()}"
+        with tweet_store.TweetWriter(filename) as writer:
+            if self.accounts:
+                logger.info(f"{self.name}: Loading tweets from {len(self.accounts)} accounts")
+                await twitter.query_by_username(self.accounts, date_from, date_to, session, bearer, since_id=since_id, writer=writer)
+
+            if self.search_words:
+                logger.info(f"{self.name}: Loading tweets with {len(self.search_words)} search words")
+                await twitter.query_by_search_words(self.search_words, date_from, date_to, session, bearer, since_id=since_id, writer=writer)
         
-        logger.info(f"Saved {filename}")
+        logger.info(f"Saved {writer.n_tweets} tweets to {filename}")
+
+        max_id = writer.max_id
+        if since_id:
+            max_id = max(max_id, int(since_id))
+
+        await save_state(self.name, ScrapeState(str(max_id) if max_id else None, date_to), db)
         
         return True
 
 Scraper = Union[DailyTwitterScrape]
 
+_list_file_cache: Dict[str, Tuple[float, List[str]]] = {}
+
 def load_list_from_config(section: configparser.SectionProxy, name: str) -> List[str]:
     if section.get(name):
-        return list(map(str.strip, section.get("accounts").split(",")))
+        return list(map(str.strip, section.get(name).split(",")))
     
     if section.get(name + "File"):
         filename = section.get(name + "File")
-        with open(filename, "r") as f:
-            return list(map(str.strip, f.readlines()))
+        mtime = os.path.getmtime(filename)
+        if filename not in _list_file_cache or _list_file_cache[filename][0] != mtime:
+            with open(filename, "r") as f:
+                _list_file_cache[filename] = (mtime, list(map(str.strip, f.readlines())))
+        
+        return _list_file_cache[filename][1]
     
     return []
 
@@ -78,16 +115,25 @@ def load_config() -> List[Scraper]:
     
     return scrapers
 
+async def run_scraper(scraper: Scraper, session: aiohttp.ClientSession, bearer: str, db: databases.Database):
+    try:
+        logger.info(f"Running scraper {scraper.name}")
+        success = await scraper.scrape(session, bearer, db)
+        if not success:
+            logger.info(f"Scraper {scraper.name} was not run")
+    
+    except:
+        logger.error(f"Scraper {scraper.name} failed", exc_info=sys.exc_info())
+
 async def run_daily_schedule(app: web.Application):
     try:
         scrapers = load_config()
-        async with aiohttp.ClientSession(trust_env=True) as session:
-            bearer = app["TWITTER_BEARER"]
-            for scraper in scrapers:
-                logger.info(f"Running scraper {scraper.name}")
-                success = await scraper.scrape(session, bearer)
-                if not success:
-                    logger.info(f"Scraper {scraper.name} was not run")
+        session: aiohttp.ClientSession = app["client_session"]
+        bearer = app["TWITTER_BEARER"]
+        # Twitter-kyselyt rajoitetaan yhteisellä lukolla (twitter.twitter_lock), joten skreippaukset voivat
+        # edetä rinnakkain
+        await asyncio.gather(*(run_scraper(scraper, session, bearer, app["db"]) for scraper in scrapers))
     
     except:
         logger.error("Failed to run daily schedule", exc_info=sys.exc_info())
+
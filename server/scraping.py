@@ -1,11 +1,20 @@
 import asyncio
+import concurrent.futures
+import contextlib
 import datetime
 import logging
 import random
 import re
-from server.tweet_db import load_tweet_database
+from server.articles import INCOMPLETE_COLUMN, load_content_hash, save_content_hash, save_resource
+from server.breakers import SkippedStage, TicketBudget, call_backend
+from server.checkpoints import Checkpoints, delete_checkpoints
+from server.pipeline import Item, Pipeline, Stage
+from server.search_cache import SearchCache
+from server.singleflight import SingleFlight
+from server.snapshots import save_snapshot
+from server.tweet_db import INTERACTION_COLUMNS, join_user_metadata, load_tweet_database, load_user_metadata
 import sys
-from typing import Any, Coroutine, List, NamedTuple, Type
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Coroutine, Dict, List, NamedTuple, Optional, Set, Tuple, Type
 
 import aiohttp
 import databases
@@ -14,9 +23,10 @@ import pandas as pd
 import sentiment
 from aiohttp import web
 import json
-from scrapers import fetch, query
+from scrapers import client, fetch, query
 from scrapers.alma import ILQuery
-from scrapers.sanoma import HSQuery, ISQuery, create_hs_session
+from scrapers.sanoma import HSFetch, HSQuery, ISQuery, create_hs_session, extract_article, fetch_html_with_cookies, load_cookies
+from scrapers.tweet_store import TweetWriter, default_extension
 from scrapers.twitter import get_tweets_with_url, query_by_username
 from scrapers.yle import YleQuery
 
@@ -28,6 +38,8 @@ class Sessions(NamedTuple):
     aiohttp_session: aiohttp.ClientSession
     app: web.Application
     db_session: databases.Database
+    checkpoints: Checkpoints
+    budget: TicketBudget
 
 async def get_cached_value(cache_table: str, url: str, db: databases.Database):
     query = f"""
@@ -41,294 +53,601 @@ async def save_cached_value(cache_table: str, url: str, content: str, db: databa
     INSERT INTO cache (key, content) VALUES (:key, :content);
     """, { "key": cache_table + " " + url, "content": content })
 
-def create_scraper(queryClass: Type[query.PaginatedQuery]):
-    lock = asyncio.Lock()
-    async def scraper(params: query.Params, sessions: Sessions):
-        async with lock:
-            query = queryClass(params)
-            df = await query.scrape(sessions.aiohttp_session)
-            if "content" not in params.enabled:
-                return df
-            
-            fetch_results = []
-            for url in df["url"]:
-                cached = await get_cached_value("scrape_cache", url, sessions.db_session)
-                if cached:
-                    fetch_results.append(fetch.FetchResult.from_json(cached))
-                
-                else:
-                    fetch_result = await fetch.css_fetch(url, sessions.aiohttp_session)
-                    if fetch_result:
-                        fetch_results.append(fetch_result)
-                        await save_cached_value("scrape_cache", url, fetch_result.to_json(), sessions.db_session)
-                    
-                    else:
-                        fetch_results.append(fetch.FetchResult(content="", persons=[]))
-                    
-                    await asyncio.sleep(random.random()*2)
-            
-            df["content"] = [r.content for r in fetch_results]
-            df["persons"] = [r.persons for r in fetch_results]
+# Kielenkäsittelyn välimuistien avain on artikkelin tekstin tiiviste (ks. articles.content_hash), joka luetaan
+# content_hashes-taulusta osoitteen perusteella. Tyhjästä sisällöstä (esim. epäonnistunut haku) ei lasketa tiivistettä,
+# jotteivät kaikki tyhjät artikkelit jaa samaa tulosta, vaan avaimena käytetään osoitetta.
+async def enrichment_key(item: Item, db: databases.Database) -> str:
+    url = item.row["url"]
+    content = item.row["content"]
+    if not isinstance(content, str) or not content.strip():
+        return url
+
+    return await load_content_hash(db, url) or await save_content_hash(db, url, content)
+
+async def get_enrichment(cache_table: str, item: Item, db: databases.Database):
+    key = await enrichment_key(item, db)
+    cached = await get_cached_value(cache_table, key, db)
+    if cached or key == item.row["url"]:
+        return cached
+
+    # Ennen tiivisteitä tulokset tallennettiin osoitteen perusteella
+    return await get_cached_value(cache_table, item.row["url"], db)
+
+async def save_enrichment(cache_table: str, item: Item, content: str, db: databases.Database):
+    # Sama teksti voi tulla uudelleen käsitellyksi (esim. tyhjät NER-tulokset), joten vanha tulos korvataan
+    await db.execute("""
+    INSERT OR REPLACE INTO cache (key, content) VALUES (:key, :content);
+    """, {"key": cache_table + " " + await enrichment_key(item, db), "content": content})
+
+# Palauttaa hakutulokset DataFrame-erinä sitä mukaa kuin sivuja saapuu. Koko tulosjoukko tallennetaan välitulokseksi,
+# kun haku on valmis.
+async def search(paginated_query: query.PaginatedQuery, sessions: Sessions) -> AsyncIterator[pd.DataFrame]:
+    df = await sessions.checkpoints.load("search")
+    if df is not None:
+        logger.info(f"Using checkpointed search results")
+        yield df
+        return
+    
+    batches = []
+    start = 0
+    async for results in paginated_query.iter_results(sessions.aiohttp_session):
+        batch = pd.DataFrame(results, index=range(start, start+len(results)))
+        start += len(results)
+        batches.append(batch)
+        yield batch
+    
+    await sessions.checkpoints.save("search", _concat(batches))
 
-        coroutines = []
+def search_cache(sessions: Sessions) -> SearchCache:
+    return SearchCache(sessions.db_session, sessions.app["SEARCH_CACHE_FINAL_DAYS"], sessions.app["SEARCH_CACHE_TTL"])
 
-        if "parser" in params.enabled and sessions.app["PARSER_ENABLED"]:
-            coroutines.append(parse_to_conllu(df, sessions))
-        
-        if "ner" in params.enabled and sessions.app["NER_ENABLED"]:
-            coroutines.append(get_named_entities(df, sessions))
-        
-        if "twitter" in params.enabled and sessions.app["TWITTER_ENABLED"]:
-            coroutines.append(get_tweets(df, sessions))
+def _concat(batches: List[pd.DataFrame]) -> pd.DataFrame:
+    return pd.concat(batches) if batches else pd.DataFrame()
+
+async def collect(batches: AsyncIterable[pd.DataFrame]) -> pd.DataFrame:
+    return _concat([batch async for batch in batches])
+
+# Työvaiheet, joiden tulos riippuu vain artikkelin tekstistä
+CONTENT_STAGES = {"parser", "ner", "annif", "sentiment"}
 
-        if "sentiment" in params.enabled:
-            coroutines.append(predict_sentiment(df))
+# Kuinka monen artikkelin välein kesken olevan työvaiheen valmiit artikkelit tallennetaan
+CHECKPOINT_INTERVAL = 20
+
+# Työvaiheiden rinnakkaisuus yhden toimeksiannon sisällä
+STAGE_CONCURRENCY = {
+    "content": 1,
+    "parser": 2,
+    "ner": 2,
+    "annif": 4,
+    "sentiment": 1,
+    "tweets": 1,
+}
+
+async def fetch_article(url: str, sessions: Sessions, fetch_uncached: Callable[[str], Awaitable[Optional[fetch.FetchResult]]], delay: Callable[[], float]) -> fetch.FetchResult:
+    cached = await get_cached_value("scrape_cache", url, sessions.db_session)
+    if cached:
+        return fetch.FetchResult.from_json(cached)
+    
+    fetch_result = await fetch_uncached(url)
+    if fetch_result:
+        await save_cached_value("scrape_cache", url, fetch_result.to_json(), sessions.db_session)
+    
+    else:
+        fetch_result = fetch.FetchResult(content="", persons=[])
     
-        if "annif" in params.enabled and sessions.app["ANNIF_ENABLED"]:
-            coroutines.append(predict_subjects(df, sessions))
+    await asyncio.sleep(delay())
+    return fetch_result
+
+def _progress(item: Item) -> str:
+    return f"({item.index+1})"
+
+async def enrich(
+    search: AsyncIterable[pd.DataFrame],
+    params: query.Params,
+    sessions: Sessions,
+    fetch_uncached: Optional[Callable[[str], Awaitable[Optional[fetch.FetchResult]]]] = None,
+    delay: Callable[[], float] = lambda: 0,
+    tweets: bool = True,
+    fetch_concurrency: int = STAGE_CONCURRENCY["content"],
+) -> pd.DataFrame:
+    # Sisällön haku ja rikastavat työvaiheet ajetaan artikkelikohtaisena liukuhihnana, joka alkaa heti ensimmäisen
+    # hakutulossivun saavuttua. Keskeytyneen toimeksiannon valmiiksi tallennetut työvaiheet ladataan välituloksista
+    # eikä niitä ajeta uudestaan, ja kesken jääneistä työvaiheista käsitellään vain puuttuvat artikkelit. Jos toinen
+    # toimeksianto käsittelee samaa artikkelia (tai samaa tekstiä) samassa työvaiheessa, odotetaan sen tulosta eikä
+    # tehdä samaa työtä kahdesti. Epäonnistuneiden ja ohitettujen työvaiheiden sarakkeet merkitään keskeneräisiksi,
+    # jotta oletusarvot eivät korvaa artikkelivarastossa olevia tuloksia.
+    stages: List[Stage] = []
+    checkpointed: Dict[str, List[dict]] = {}
+    # Kesken olevien työvaiheiden valmiit artikkelit osoitteen mukaan ja vielä tallentamattomat artikkelit
+    completed: Dict[str, Dict[str, tuple]] = {}
+    unsaved: Dict[str, List[Tuple[str, tuple]]] = {}
+    # Artikkelit (järjestysnumerot), joiden työvaihe epäonnistui tai ohitettiin
+    failed: Dict[str, Set[int]] = {}
+    singleflight: SingleFlight = sessions.app["singleflight"]
+
+    def shared(name: str, process: Callable[[Item], Awaitable[tuple]]) -> Callable[[Item], Awaitable[tuple]]:
+        async def run(item: Item) -> tuple:
+            key = await enrichment_key(item, sessions.db_session) if name in CONTENT_STAGES else item.row["url"]
+            ran = False
+
+            def call() -> Awaitable[tuple]:
+                nonlocal ran
+                ran = True
+                return process(item)
+
+            try:
+                return await singleflight.do((name, key), call)
+            
+            except SkippedStage:
+                # Jaettu laskenta ajettiin toisen toimeksiannon budjetilla. Sen ohitus ei koske tätä toimeksiantoa,
+                # joten työvaihe ajetaan uudelleen tämän toimeksiannon budjetilla.
+                if ran:
+                    raise
+                
+                return await process(item)
+        
+        return run
+
+    async def flush(name: str):
+        rows, unsaved[name] = unsaved[name], []
+        if rows:
+            await sessions.checkpoints.save_rows(name, rows)
+
+    def resumable(name: str, process: Callable[[Item], Awaitable[tuple]], default: tuple) -> Callable[[Item], Awaitable[tuple]]:
+        async def run(item: Item) -> tuple:
+            url = item.row["url"]
+            if url in completed[name]:
+                return completed[name][url]
+            
+            # Tyhjää sisältöä ei käsitellä, koska tulokset korvaisivat aiemmin haetusta sisällöstä lasketut
+            if item.index in failed.get("content", ()):
+                failed[name].add(item.index)
+                return default
+            
+            try:
+                values = await process(item)
+            
+            except Exception:
+                # Virheet on jo kirjattu lokiin työvaiheessa
+                failed[name].add(item.index)
+                return default
+            
+            unsaved[name].append((url, values))
+            if len(unsaved[name]) >= CHECKPOINT_INTERVAL:
+                await flush(name)
+            
+            return values
         
-        await asyncio.gather(*coroutines)
+        return run
 
-        return df
-    
-    return scraper
+    async def add_stage(name: str, columns: List[str], process: Callable[[Item], Awaitable[tuple]], default: tuple, after: Optional[str], concurrency: Optional[int] = None):
+        checkpoint = await sessions.checkpoints.load(name)
+        if checkpoint is not None:
+            logger.info(f"Using checkpointed {name} results")
+            checkpointed[name] = checkpoint[columns].to_dict("records")
+        
+        else:
+            completed[name] = await sessions.checkpoints.load_rows(name)
+            unsaved[name] = []
+            if completed[name]:
+                logger.info(f"Resuming {name} with {len(completed[name])} checkpointed articles")
+            
+            failed[name] = set()
+            stages.append(Stage(name, columns, resumable(name, shared(name, process), default), default, concurrency or STAGE_CONCURRENCY[name], after))
 
-hs_lock = asyncio.Lock()
-async def hs_scraper(params: query.Params, sessions: Sessions):
-    async with hs_lock:
-        query = HSQuery(params)
-        df = await query.scrape(sessions.aiohttp_session)
-        if "content" not in params.enabled:
-            return df
+    async def content_stage(item: Item) -> tuple:
+        logger.info(f"{_progress(item)} Fetching {item.row['url']}")
+        try:
+            result = await fetch_article(item.row["url"], sessions, fetch_uncached, delay)
         
-        fetch_results = []
-        async with create_hs_session(sessions.app["HS_USERNAME"], sessions.app["HS_PASSWORD"]) as hs_fetch:
-            for url in df["url"]:
-                cached = await get_cached_value("scrape_cache", url, sessions.db_session)
-                if cached:
-                    fetch_results.append(fetch.FetchResult.from_json(cached))
-                
-                else:
-                    fetch_result = await hs_fetch.fetch_hs(url)
-                    if fetch_result:
-                        fetch_results.append(fetch_result)
-                        await save_cached_value("scrape_cache", url, fetch_result.to_json(), sessions.db_session)
-                    
-                    else:
-                        fetch_results.append(fetch.FetchResult(content="", persons=[]))
-                    
-                    await asyncio.sleep(1+random.random()*2)
+        except Exception:
+            logger.error(f"Error during fetching {item.row['url']}", exc_info=sys.exc_info())
+            raise
+        
+        if not result.content:
+            raise SkippedStage("content")
         
-        df["content"] = [r.content for r in fetch_results]
-        df["persons"] = [r.persons for r in fetch_results]
+        await save_content_hash(sessions.db_session, item.row["url"], result.content)
+        return result.content, result.persons
 
-    coroutines = []
+    if fetch_uncached:
+        await add_stage("content", ["content", "persons"], content_stage, ("", []), None, fetch_concurrency)
+    
+    # Jos sisältö on jo ladattu, rikastavat työvaiheet voivat alkaa heti
+    content = "content" if "content" in [stage.name for stage in stages] else None
 
     if "parser" in params.enabled and sessions.app["PARSER_ENABLED"]:
-        coroutines.append(parse_to_conllu(df, sessions))
+        await add_stage("parser", ["conllu"], lambda item: parse_to_conllu(item, sessions), ("",), content)
     
     if "ner" in params.enabled and sessions.app["NER_ENABLED"]:
-        coroutines.append(get_named_entities(df, sessions))
+        await add_stage("ner", ["entities"], lambda item: get_named_entities(item, sessions), ([],), content)
     
-    if "twitter" in params.enabled and sessions.app["TWITTER_ENABLED"]:
-        coroutines.append(get_tweets(df, sessions))
+    if tweets and "twitter" in params.enabled and sessions.app["TWITTER_ENABLED"]:
+        await add_stage("tweets", ["tweets", "tweet_sentiments"], lambda item: get_tweets(item, sessions), ([], []), content)
 
     if "sentiment" in params.enabled:
-        coroutines.append(predict_sentiment(df))
-    
+        await add_stage("sentiment", ["sentiment"], lambda item: predict_sentiment(item, sessions), (np.nan,), content)
+
     if "annif" in params.enabled and sessions.app["ANNIF_ENABLED"]:
-        coroutines.append(predict_subjects(df, sessions))
-    
-    await asyncio.gather(*coroutines)
+        await add_stage("annif", ["subjects"], lambda item: predict_subjects(item, sessions), ([],), content)
+
+    batches: List[pd.DataFrame] = []
+    async def items():
+        # Rivit tunnistetaan järjestysnumerolla, koska hakutulosten indeksi ei välttämättä ole yksikäsitteinen
+        position = 0
+        async for batch in search:
+            batches.append(batch)
+            for row in batch.to_dict("records"):
+                for values in checkpointed.values():
+                    row.update(values[position])
+                
+                # Artikkeli, jonka kaikki työvaiheet on jo tallennettu, ohitetaan
+                if not all(row["url"] in completed[stage.name] for stage in stages):
+                    yield Item(position, row)
+                
+                position += 1
 
+    try:
+        results = await Pipeline(stages).run(items())
+    
+    finally:
+        for stage in stages:
+            await flush(stage.name)
+
+    df = _concat(batches)
+    urls = list(df["url"]) if len(df) else []
+    for values in checkpointed.values():
+        for column in values[0] if values else []:
+            df[column] = [v[column] for v in values]
+
+    for stage in stages:
+        values = [
+            results[stage.name][position] if position in results[stage.name] else completed[stage.name][urls[position]]
+            for position in range(len(df))
+        ]
+        for i, column in enumerate(stage.columns):
+            df[column] = [v[i] for v in values]
+        
+        await sessions.checkpoints.save(stage.name, df, stage.columns)
+        await sessions.checkpoints.delete_rows(stage.name)
+    
+    incomplete: List[List[str]] = [[] for _ in range(len(df))]
+    for stage in stages:
+        for position in failed[stage.name]:
+            incomplete[position] += stage.columns
+    
+    df[INCOMPLETE_COLUMN] = incomplete
+    
     return df
 
-tweet_lock = asyncio.Lock()
-async def get_tweets(df: pd.DataFrame, sessions: Sessions):
-    async with tweet_lock:
-        tweets_column = []
-        sentiment_column = []
-        for i, (url, date_modified) in enumerate(zip(df["url"], df["date_modified"])):
-            tweets = []
-            sentiments = []
-            logger.info(f"({i+1}/{len(df)}) Getting tweets with {url} ({date_modified})")
-            try:
-                date_modified = pd.to_datetime(date_modified, utc=True)
-                date_modified = datetime.datetime.combine(date_modified.date(), date_modified.time())
-                cache_key = f"get_tweets_with_url({url}, {date_modified} +- 1 week)"
-                cached = await get_cached_value("tweet_cache", cache_key, sessions.db_session)
-                if cached:
-                    tweets = json.loads(cached)
-                
-                else:
-                    tweets = await get_tweets_with_url(
-                        url,
-                        start_date=date_modified-datetime.timedelta(weeks=1),
-                        end_date=date_modified+datetime.timedelta(weeks=1),
-                        session=sessions.aiohttp_session,
-                        bearer=sessions.app["TWITTER_BEARER"]
-                    )
-                    if tweets:
-                        await save_cached_value("tweet_cache", cache_key, json.dumps(tweets), sessions.db_session)
-
-                logger.info(f"({i+1}/{len(df)}) Calculating sentiments for tweets with {url} ({date_modified})")
-
-                for j, tweet in enumerate(tweets):
-                    sentences = re.split("[.!?] ", tweet["text"])
-                    sentiments.append(np.mean((finnsentiment_model.predict(sentences)*[-1, 0, 1]).sum(-1)))
-                    await asyncio.sleep(0)
-            
-            except:
-                logger.error("Error during fetching tweets", exc_info=sys.exc_info())
-            
-            tweets_column.append(tweets)
-            sentiment_column.append(sentiments)
-            await asyncio.sleep(3.1)
-    
-        df["tweets"] = tweets_column
-        df["tweet_sentiments"] = sentiment_column
-
-async def parse_to_conllu(df: pd.DataFrame, sessions: Sessions):
-    conllus = []
-    for i, (url, content) in enumerate(zip(df["url"], df["content"])):
-        logger.info(f"({i+1}/{len(df)}) Parsing text from {url}")
-        if not isinstance(content, str):
-            logger.warning(f"The content of {url} is not str, it is {content}")
-        
-        conllu = ""
+extract_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="extract")
+
+# Tallentaa haetun sivun raaka-HTML:n ja poimii siitä artikkelin
+async def snapshot_and_extract(url: str, html: Optional[str], sessions: Sessions) -> Optional[fetch.FetchResult]:
+    if html is None:
+        return None
+    
+    if sessions.app["SNAPSHOT_DIR"]:
         try:
-            cached = await get_cached_value("parser_cache", url, sessions.db_session)
-            if cached:
-                conllu = cached
-            
-            else:
-                async with sessions.aiohttp_session.post(sessions.app["PARSER_URL"], data=content.encode("utf-8"), headers={"Content-Type": "text/plain; charset=utf-8"}) as response:
-                    conllu = await response.text()
-                
-                await save_cached_value("parser_cache", url, conllu, sessions.db_session)
+            await save_snapshot(sessions.db_session, sessions.app["SNAPSHOT_DIR"], url, html)
         
-        except:
-            logger.error("Error during parsing", exc_info=sys.exc_info())
-        
-        conllus.append(conllu)
+        except Exception:
+            logger.error(f"Failed to save snapshot of {url}", exc_info=sys.exc_info())
     
-    df["conllu"] = conllus
+    # Jäsennys ajetaan säikeessä, jotta tapahtumasilmukka ei pysähdy sen ajaksi
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(extract_executor, extract_article, url, html)
 
-async def get_named_entities(df: pd.DataFrame, sessions: Sessions):
-    entities_column = []
-    for i, (url, content) in enumerate(zip(df["url"], df["content"])):
-        if not isinstance(content, str):
-            logger.warning(f"The content of {url} is not str, it is {content}")
+def create_scraper(queryClass: Type[query.PaginatedQuery]):
+    lock = asyncio.Lock()
+    async def fetch_uncached(url: str, sessions: Sessions) -> Optional[fetch.FetchResult]:
+        # Samalta sivustolta haetaan yksi artikkeli kerrallaan myös silloin, kun toimeksiantoja on useita
+        async with lock:
+            html = await fetch.fetch_html(url, sessions.aiohttp_session)
         
-        cached = await get_cached_value("ner_cache", url, sessions.db_session)
-        if cached:
-            entities = json.loads(cached)
-            if entities:
-                logger.info(f"({i+1}/{len(df)}) Using cached NER entities for {url}")
-                entities_column.append(entities)
-                continue
+        return await snapshot_and_extract(url, html, sessions)
+    
+    async def scraper(params: query.Params, sessions: Sessions):
+        if "content" not in params.enabled:
+            return await collect(search(queryClass(params, search_cache(sessions)), sessions))
         
-        entities = []
+        return await enrich(search(queryClass(params, search_cache(sessions)), sessions), params, sessions, lambda url: fetch_uncached(url, sessions), lambda: random.random()*2)
+    
+    return scraper
+
+# Selain ja sen välilehdet jaetaan samanaikaisten HS-toimeksiantojen kesken. Selain käynnistetään vasta, kun
+# ensimmäistä artikkelia ei löydy välimuistista eikä sitä saada haettua ilman selainta, ja suljetaan, kun viimeinen
+# sitä käyttävä toimeksianto päättyy.
+class SharedHSFetch:
+    def __init__(self):
+        self.hs_fetch: Optional[HSFetch] = None
+        self.stack: Optional[contextlib.AsyncExitStack] = None
+        self.users = 0
+        self.lock = asyncio.Lock()
+
+    async def get(self, sessions: Sessions) -> HSFetch:
+        async with self.lock:
+            if not self.hs_fetch:
+                stack = contextlib.AsyncExitStack()
+                self.hs_fetch = await stack.enter_async_context(create_hs_session(sessions.app["HS_USERNAME"], sessions.app["HS_PASSWORD"], sessions.app["HS_TABS"], sessions.app["HS_COOKIES"]))
+                self.stack = stack
+            
+            return self.hs_fetch
+
+    @contextlib.asynccontextmanager
+    async def use(self):
+        self.users += 1
         try:
-            logger.info(f"({i+1}/{len(df)}) NER tagging text from {url}")
-            for line in content.split("\n"):
-                line = line.strip()
-                if not line:
-                    continue
-                
-                if len(line) > 4090:
-                    logger.warning(f"Too long line for NER tagging: {len(line)}")
-                    line = line[:4090] # liian pitkä rivi käsiteltäväksi, pitää leikata :(
-                
-                async with sessions.aiohttp_session.post(sessions.app["NER_URL"], params={"text": line}, headers={"Content-Type": "text/plain; charset=utf-8"}) as resp:
-                    data = await resp.json()
-                
-                entity = None
-                for sentence in data:
-                    for [form, lemma, analysis, ner_analysis, ner_tag, _, _, _] in sentence:
-                        if entity:
-                            entity += " " + lemma
-                        
-                        if re.fullmatch(r"<\w+/>", ner_tag):
-                            entities.append((ner_tag[1:-2], lemma))
-                        
-                        elif re.fullmatch(r"<(\w+)>", ner_tag):
-                            entity = lemma
-                        
-                        elif re.fullmatch(r"</(\w+)>", ner_tag):
-                            entities.append((ner_tag[2:-1], entity))
-                            entity = None
-                
-            await save_cached_value("ner_cache", url, json.dumps(entities), sessions.db_session)
+            yield self
         
-        except:
-            logger.error("Error during NER tagging", exc_info=sys.exc_info())
-        
-        entities_column.append(entities)
+        finally:
+            self.users -= 1
+            async with self.lock:
+                if self.users == 0 and self.stack:
+                    stack, self.stack, self.hs_fetch = self.stack, None, None
+                    await stack.aclose()
+
+shared_hs_fetch = SharedHSFetch()
+# Jos näin monta artikkelia peräkkäin vaatii selaimen, loput haetaan suoraan selaimella
+HS_MAX_PLAIN_MISSES = 5
+async def hs_scraper(params: query.Params, sessions: Sessions):
+    if "content" not in params.enabled:
+        return await collect(search(HSQuery(params, search_cache(sessions)), sessions))
     
-    df["entities"] = entities_column
+    async with shared_hs_fetch.use():
+        # Kuinka monta artikkelia peräkkäin ei saatu ilman selainta
+        plain_misses = 0
+        # Tallennetut evästeet luetaan kerran toimeksiantoa kohden. Käynnissä olevan selaimen evästeet ovat tuoreemmat.
+        saved_cookies = load_cookies(sessions.app["HS_COOKIES"])
+        async def fetch_uncached(url: str) -> Optional[fetch.FetchResult]:
+            nonlocal plain_misses
+            hs_fetch = shared_hs_fetch.hs_fetch
+            cookies = hs_fetch.cookies if hs_fetch else saved_cookies
+            if cookies and plain_misses < HS_MAX_PLAIN_MISSES:
+                html = await fetch_html_with_cookies(url, sessions.aiohttp_session, cookies)
+                if html is not None:
+                    plain_misses = 0
+                    return await snapshot_and_extract(url, html, sessions)
+                
+                plain_misses += 1
+            
+            # Artikkeleita haetaan rinnakkain selaimen välilehdiltä
+            hs_fetch = await shared_hs_fetch.get(sessions)
+            html = await hs_fetch.fetch_html(url)
+            return await snapshot_and_extract(url, html, sessions)
+        
+        return await enrich(search(HSQuery(params, search_cache(sessions)), sessions), params, sessions, fetch_uncached, lambda: 1+random.random()*2, fetch_concurrency=sessions.app["HS_TABS"])
 
-async def predict_subjects(df: pd.DataFrame, sessions: Sessions):
-    subject_column = []
-    for i, (url, content) in enumerate(zip(df["url"], df["content"])):
-        logger.info(f"({i+1}/{len(df)}) Predicting subjects for {url}")
-        if not isinstance(content, str):
-            logger.warning(f"The content of {url} is not str, it is {content}")
+tweet_lock = asyncio.Lock()
+async def get_tweets(item: Item, sessions: Sessions) -> tuple:
+    url = item.row["url"]
+    date_modified = item.row["date_modified"]
+    tweets = []
+    sentiments = []
+    logger.info(f"{_progress(item)} Getting tweets with {url} ({date_modified})")
+    try:
+        date_modified = pd.to_datetime(date_modified, utc=True)
+        date_modified = datetime.datetime.combine(date_modified.date(), date_modified.time())
+        cache_key = f"get_tweets_with_url({url}, {date_modified} +- 1 week)"
+        cached = await get_cached_value("tweet_cache", cache_key, sessions.db_session)
+        if cached:
+            tweets = json.loads(cached)
         
-        uris = []
-        subjects = ""
-        try:
-            cached = await get_cached_value("subject_cache", url, sessions.db_session)
-            if cached:
-                subjects = cached
+        else:
+            async with tweet_lock:
+                tweets = await get_tweets_with_url(
+                    url,
+                    start_date=date_modified-datetime.timedelta(weeks=1),
+                    end_date=date_modified+datetime.timedelta(weeks=1),
+                    session=sessions.aiohttp_session,
+                    bearer=sessions.app["TWITTER_BEARER"]
+                )
+                await asyncio.sleep(3.1)
             
-            else:
-                params = {
-                    "text": content,
-                    "limit": 15,
-                    "threshold": 0.2,
-                }
-                annif_url = f"{sessions.app['ANNIF_URL']}"
-                async with sessions.aiohttp_session.post(annif_url, data=params) as response:
-                    subjects = await response.text()
-                
-                await save_cached_value("subject_cache", url, subjects, sessions.db_session)
-                
-            for result in json.loads(subjects)["results"]:
-                uri = f"<{result['uri']}>"
-                uris.append(uri)
-        
-        except:
-            logger.error("Error during subject prediction", exc_info=sys.exc_info())
+            if tweets:
+                await save_cached_value("tweet_cache", cache_key, json.dumps(tweets), sessions.db_session)
+
+        logger.info(f"{_progress(item)} Calculating sentiments for tweets with {url} ({date_modified})")
+
+        for tweet in tweets:
+            sentiments.append(await _sentiment(tweet["text"]))
+    
+    except Exception:
+        logger.error("Error during fetching tweets", exc_info=sys.exc_info())
+        raise
+    
+    return tweets, sentiments
+
+async def parse_to_conllu(item: Item, sessions: Sessions) -> tuple:
+    url = item.row["url"]
+    content = item.row["content"]
+    logger.info(f"{_progress(item)} Parsing text from {url}")
+    if not isinstance(content, str):
+        logger.warning(f"The content of {url} is not str, it is {content}")
+    
+    conllu = ""
+    try:
+        cached = await get_enrichment("parser_cache", item, sessions.db_session)
+        if cached:
+            conllu = cached
         
-        subject_column.append(uris)
+        else:
+            async def parse() -> str:
+                async with client.request(sessions.aiohttp_session, "POST", sessions.app["PARSER_URL"], "parser", data=content.encode("utf-8"), headers={"Content-Type": "text/plain; charset=utf-8"}) as response:
+                    response.raise_for_status()
+                    return await response.text()
+            
+            conllu = await call_backend("parser", sessions.app, sessions.aiohttp_session, sessions.budget, parse)
+            await save_enrichment("parser_cache", item, conllu, sessions.db_session)
+    
+    except SkippedStage:
+        raise
     
-    df["subjects"] = subject_column
+    except Exception:
+        logger.error("Error during parsing", exc_info=sys.exc_info())
+        raise
+    
+    return (conllu,)
 
-async def predict_sentiment(df: pd.DataFrame):
-    sentiment_column = []
-    for i, (url, content) in enumerate(zip(df["url"], df["content"])):
-        try:
-            logger.info(f"({i+1}/{len(df)}) Calculating sentiments for {url}")
-            sentences = re.split("[.!?] ", content)
-            sentiment_column.append(np.mean((finnsentiment_model.predict(sentences)*[-1, 0, 1]).sum(-1)))
-            await asyncio.sleep(0)
+async def get_named_entities(item: Item, sessions: Sessions) -> tuple:
+    url = item.row["url"]
+    content = item.row["content"]
+    if not isinstance(content, str):
+        logger.warning(f"The content of {url} is not str, it is {content}")
+    
+    cached = await get_enrichment("ner_cache", item, sessions.db_session)
+    if cached:
+        entities = json.loads(cached)
+        if entities:
+            logger.info(f"{_progress(item)} Using cached NER entities for {url}")
+            return (entities,)
+    
+    entities = []
+    try:
+        logger.info(f"{_progress(item)} NER tagging text from {url}")
+        for line in content.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            
+            if len(line) > 4090:
+                logger.warning(f"Too long line for NER tagging: {len(line)}")
+                line = line[:4090] # liian pitkä rivi käsiteltäväksi, pitää leikata :(
+            
+            async def tag() -> list:
+                async with client.request(sessions.aiohttp_session, "POST", sessions.app["NER_URL"], "ner", params={"text": line}, headers={"Content-Type": "text/plain; charset=utf-8"}) as resp:
+                    resp.raise_for_status()
+                    return await resp.json()
+            
+            data = await call_backend("ner", sessions.app, sessions.aiohttp_session, sessions.budget, tag)
+            
+            entity = None
+            for sentence in data:
+                for [form, lemma, analysis, ner_analysis, ner_tag, _, _, _] in sentence:
+                    if entity:
+                        entity += " " + lemma
+                    
+                    if re.fullmatch(r"<\w+/>", ner_tag):
+                        entities.append((ner_tag[1:-2], lemma))
+                    
+                    elif re.fullmatch(r"<(\w+)>", ner_tag):
+                        entity = lemma
+                    
+                    elif re.fullmatch(r"</(\w+)>", ner_tag):
+                        entities.append((ner_tag[2:-1], entity))
+                        entity = None
+            
+        await save_enrichment("ner_cache", item, json.dumps(entities), sessions.db_session)
+    
+    except SkippedStage:
+        raise
     
-        except:
-            logger.info(f"Skipping sentiment for {url}")
-            sentiment_column.append(np.nan)
-    df["sentiment"] = sentiment_column
+    except Exception:
+        logger.error("Error during NER tagging", exc_info=sys.exc_info())
+        raise
+    
+    return (entities,)
+
+async def predict_subjects(item: Item, sessions: Sessions) -> tuple:
+    url = item.row["url"]
+    content = item.row["content"]
+    logger.info(f"{_progress(item)} Predicting subjects for {url}")
+    if not isinstance(content, str):
+        logger.warning(f"The content of {url} is not str, it is {content}")
+    
+    uris = []
+    subjects = ""
+    try:
+        cached = await get_enrichment("subject_cache", item, sessions.db_session)
+        if cached:
+            subjects = cached
+        
+        else:
+            params = {
+                "text": content,
+                "limit": 15,
+                "threshold": 0.2,
+            }
+            annif_url = f"{sessions.app['ANNIF_URL']}"
+            async def suggest() -> str:
+                async with client.request(sessions.aiohttp_session, "POST", annif_url, "annif", data=params) as response:
+                    response.raise_for_status()
+                    return await response.text()
+            
+            subjects = await call_backend("annif", sessions.app, sessions.aiohttp_session, sessions.budget, suggest)
+            await save_enrichment("subject_cache", item, subjects, sessions.db_session)
+            
+        for result in json.loads(subjects)["results"]:
+            uri = f"<{result['uri']}>"
+            uris.append(uri)
+    
+    except SkippedStage:
+        raise
+    
+    except Exception:
+        logger.error("Error during subject prediction", exc_info=sys.exc_info())
+        raise
+    
+    return (uris,)
+
+async def _sentiment(text: str) -> float:
+    # Malli ajetaan säikeessä, jotta tapahtumasilmukka ei pysähdy laskennan ajaksi
+    sentences = re.split("[.!?] ", text)
+    loop = asyncio.get_event_loop()
+    prediction = await loop.run_in_executor(None, finnsentiment_model.predict, sentences)
+    return np.mean((prediction*[-1, 0, 1]).sum(-1))
+
+async def predict_sentiment(item: Item, sessions: Sessions) -> tuple:
+    url = item.row["url"]
+    try:
+        cached = await get_enrichment("sentiment_cache", item, sessions.db_session)
+        if cached:
+            return (json.loads(cached),)
+        
+        logger.info(f"{_progress(item)} Calculating sentiments for {url}")
+        sentiment = float(await _sentiment(item.row["content"]))
+        await save_enrichment("sentiment_cache", item, json.dumps(sentiment), sessions.db_session)
+        return (sentiment,)
+
+    except Exception:
+        logger.info(f"Skipping sentiment for {url}")
+        raise
 
 async def twitter_scraper(params: query.Params, sessions: Sessions):
+    return await enrich(search_tweets(params, sessions), params, sessions, tweets=False)
+
+async def search_tweets(params: query.Params, sessions: Sessions) -> AsyncIterator[pd.DataFrame]:
+    tweets = await sessions.checkpoints.load("search")
+    if tweets is None:
+        tweets = await load_tweets(params, sessions)
+    
+    else:
+        logger.info(f"Using checkpointed tweets")
+
+    yield tweets
+
+async def load_tweets(params: query.Params, sessions: Sessions) -> pd.DataFrame:
+    # Tviittitietokannan lataus ja suodatus ajetaan säikeessä, jotta tapahtumasilmukka (ja varauksen uusiminen) ei
+    # pysähdy suurenkaan aineiston käsittelyn ajaksi
+    loop = asyncio.get_event_loop()
+    tweets = await loop.run_in_executor(None, _load_tweets, params, sessions.app["TWITTER_METADATA"])
+    await sessions.checkpoints.save("search", tweets)
+
+    return tweets
+
+def _load_tweets(params: query.Params, metadata_path: Any) -> pd.DataFrame:
     logger.info("Loading tweet database...")
-    tweets: Any = load_tweet_database(*params.extra.get("scrape_ids", [])).to_dataframe()
-    await asyncio.sleep(0)
+    tweet_db = load_tweet_database(
+        *params.extra.get("scrape_ids", []),
+        from_date=(params.from_date - datetime.timedelta(days=1)).isoformat(),
+        to_date=(params.to_date + datetime.timedelta(days=2)).isoformat(),
+    )
+    tweets: Any = tweet_db.to_dataframe()
 
     logger.info("Filtering tweets...")
     from_datetime = datetime.datetime.combine(params.from_date, datetime.time(0, 0, 0)).isoformat()
     to_datetime = datetime.datetime.combine(params.to_date, datetime.time(23, 59, 59)).isoformat()
     tweets = tweets[(from_datetime <= tweets.created_at) & (tweets.created_at <= to_datetime)]
-    await asyncio.sleep(0)
 
     if params.extra.get("drop_retweets", False):
         tweets.drop(tweets[~tweets["retweeted"].isna()].index, inplace=True)
@@ -339,47 +658,28 @@ async def twitter_scraper(params: query.Params, sessions: Sessions):
             author = [author]
         
         tweets = tweets[tweets.author_username.map(lambda u: u in author)]
-        await asyncio.sleep(0)
 
     if params.query:
         tweets = tweets[tweets.content.str.contains(params.query)]
-        await asyncio.sleep(0)
     
     logger.info("Sampling tweets...")
     if params.extra.get("sample", 0) > 0:
         tweets = tweets.sample(params.extra["sample"])
     
     logger.info("Preprocessing tweets...")
-    tweets["url"] = tweets.id.map(lambda i: f"twitter:{i}")
+    tweets["url"] = "twitter:" + tweets.id.astype(str)
     tweets["content"] = tweets.text
     del tweets["text"]
-    tweets["persons"] = tweets.content.map(lambda text: re.findall(r"@\w+", text))
-    tweets["hashtags"] = tweets.content.map(lambda text: re.findall(r"#\w+", text))
-    await asyncio.sleep(0)
+    tweets["persons"] = tweet_db.tag_lists(tweet_db.mentions, tweets.index)
+    tweets["hashtags"] = tweet_db.tag_lists(tweet_db.hashtags, tweets.index)
+    if params.extra.get("interaction_users", False):
+        for type, column in INTERACTION_COLUMNS.items():
+            tweets[column] = tweet_db.interaction_users(type, tweets.index)
 
     logger.info("Preprocessing tweets...")
-    if sessions.app["TWITTER_METADATA"]:
-        metadata = pd.read_csv(str(sessions.app["TWITTER_METADATA"]))
-        tweets = pd.merge(tweets, metadata, left_on="author_username", right_on="twitter", how="left")
-
-    coroutines = []
-
-    if "parser" in params.enabled and sessions.app["PARSER_ENABLED"]:
-        coroutines.append(parse_to_conllu(tweets, sessions))
-    
-    if "ner" in params.enabled and sessions.app["NER_ENABLED"]:
-        coroutines.append(get_named_entities(tweets, sessions))
-    
-    #if "twitter" in params.enabled and sessions.app["TWITTER_ENABLED"]:
-    #    coroutines.append(get_tweets(tweets, sessions))
-
-    if "sentiment" in params.enabled:
-        coroutines.append(predict_sentiment(tweets))
-    
-    if "annif" in params.enabled and sessions.app["ANNIF_ENABLED"]:
-        coroutines.append(predict_subjects(tweets, sessions))
-    
-    await asyncio.gather(*coroutines)
+    if metadata_path:
+        metadata = load_user_metadata(str(metadata_path))
+        tweets = join_user_metadata(tweets, metadata)
 
     return tweets
 
@@ -391,57 +691,75 @@ SCRAPERS = {
     "twitter": twitter_scraper,
 }
 
-async def start_scraping(params: query.Params, media: List[str], ticket_id: str, app: web.Application):
+# Varauksen menettänyt työntekijä ei saa kirjoittaa toimeksiannon tulosta tai tilaa uuden omistajan tilalle
+async def _owns_ticket(db: databases.Database, ticket_id: str, claim: str) -> bool:
+    row = await db.fetch_one("SELECT claim FROM tickets WHERE uuid = :id;", {"id": ticket_id})
+    return bool(row) and row["claim"] == claim
+
+async def start_scraping(params: query.Params, media: List[str], ticket_id: str, claim: str, app: web.Application):
     db: databases.Database = app["db"]
     try:
         logger.info(f"Scrape {ticket_id} started")
-        async with aiohttp.ClientSession(trust_env=True) as session:
-            sessions = Sessions(session, app, db)
-            dataframeFutures: List[Coroutine[Any, Any, pd.DataFrame]] = []
-            for media_name in media:
-                if media_name in SCRAPERS:
-                    dataframeFutures.append(SCRAPERS[media_name](params, sessions))
-
-                else:
-                    logger.warning(f"Unknown media {media_name}")
-            
-            df = pd.concat(await asyncio.gather(*dataframeFutures))
+        session: aiohttp.ClientSession = app["client_session"]
+        budget = TicketBudget(app["BACKEND_BUDGET"])
+        dataframeFutures: List[Coroutine[Any, Any, pd.DataFrame]] = []
+        for media_name in media:
+            if media_name in SCRAPERS:
+                sessions = Sessions(session, app, db, Checkpoints(db, ticket_id, media_name), budget)
+                dataframeFutures.append(SCRAPERS[media_name](params, sessions))
+
+            else:
+                logger.warning(f"Unknown media {media_name}")
+        
+        df = pd.concat(await asyncio.gather(*dataframeFutures))
         
         logger.info(f"Scrape {ticket_id} finished")
+        if not await _owns_ticket(db, ticket_id, claim):
+            logger.warning(f"Ticket {ticket_id} has been claimed by another worker, discarding the results")
+            return
 
         resource_id = ticket_id
-        await db.execute("""INSERT INTO resources(uuid, resource, date) VALUES (:id, :content, datetime('now'));""", {"id": resource_id, "content": df.to_csv()})
-        await db.execute("""UPDATE tickets SET resource_id = :resource_id WHERE uuid = :ticket_id;""", {"resource_id": resource_id, "ticket_id": ticket_id})
-        await db.execute("""UPDATE tickets SET status = 'finished' WHERE uuid = :id;""", {"id": ticket_id})
+        await save_resource(db, resource_id, df, {
+            "query": params.query,
+            "from_date": params.from_date.isoformat(),
+            "to_date": params.to_date.isoformat(),
+            "media": media,
+            "enabled": params.enabled,
+            "params": params.extra,
+        })
+        await db.execute("""UPDATE tickets SET resource_id = :resource_id WHERE uuid = :ticket_id AND claim = :claim;""", {"resource_id": resource_id, "ticket_id": ticket_id, "claim": claim})
+        if budget.skipped:
+            await db.execute("""UPDATE tickets SET skipped_stages = :skipped WHERE uuid = :id AND claim = :claim;""", {"skipped": json.dumps(budget.skipped), "id": ticket_id, "claim": claim})
+        await db.execute("""UPDATE tickets SET status = 'finished' WHERE uuid = :id AND claim = :claim;""", {"id": ticket_id, "claim": claim})
+        await delete_checkpoints(db, ticket_id)
+    except asyncio.CancelledError:
+        # Peruttu toimeksianto (esim. varaus menetettiin) jätetään jatkettavaksi eikä merkitä virheeksi
+        raise
     except:
         logger.error("Error during scraping", exc_info=sys.exc_info())
-        await db.execute("""UPDATE tickets SET status = 'error' WHERE uuid = :id;""", {"id": ticket_id})
+        await db.execute("""UPDATE tickets SET status = 'error' WHERE uuid = :id AND claim = :claim;""", {"id": ticket_id, "claim": claim})
 
-async def start_scraping_twitter(accounts: List[str], date_from: datetime.datetime, date_to: datetime.datetime, ticket_id: str, app: web.Application):
+async def start_scraping_twitter(accounts: List[str], date_from: datetime.datetime, date_to: datetime.datetime, ticket_id: str, claim: str, app: web.Application):
     db: databases.Database = app["db"]
     try:
         logger.info(f"Scrape {ticket_id} started")
-        tweets = {}
-        users = {}
         l = len(accounts)
-        async with aiohttp.ClientSession() as session:
+        session: aiohttp.ClientSession = app["client_session"]
+        with TweetWriter(f"tweets/{ticket_id}{default_extension()}") as writer:
             for i in range(0, l, 10):
                 logger.info(f"{i}/{l} Loading tweets from {', '.join(accounts[i:i+10])}")
                 for _ in range(3):
                     try:
-                        user_tweets, user_users = await query_by_username(accounts[i:i+10], date_from, date_to, session, app["TWITTER_BEARER"])
-                        tweets.update(user_tweets)
-                        users.update(user_users)
+                        await query_by_username(accounts[i:i+10], date_from, date_to, session, app["TWITTER_BEARER"], writer=writer)
                         break
                     except Exception as ex:
                         sys.stderr.write(str(ex) + "\n")
                         await asyncio.sleep(3)
         
-        with open(f"tweets/{ticket_id}.json", "w") as f:
-            json.dump({"tweets": tweets, "users": users}, f)
-        
         logger.info(f"Scrape {ticket_id} finished")
-        await db.execute("""UPDATE tickets SET status = 'finished' WHERE uuid = :id;""", {"id": ticket_id})
+        await db.execute("""UPDATE tickets SET status = 'finished' WHERE uuid = :id AND claim = :claim;""", {"id": ticket_id, "claim": claim})
+    except asyncio.CancelledError:
+        raise
     except:
         logger.error("Error during scraping", exc_info=sys.exc_info())
-        await db.execute("""UPDATE tickets SET status = 'error' WHERE uuid = :id;""", {"id": ticket_id})
+        await db.execute("""UPDATE tickets SET status = 'error' WHERE uuid = :id AND claim = :claim;""", {"id": ticket_id, "claim": claim})
@@ -0,0 +1,33 @@
+import datetime
+import json
+from typing import Optional
+
+import databases
+
+from scrapers.query import Page, Window
+
+# Hakurajapintojen tulossivujen välimuisti. Ikkunat, jotka ovat päättyneet yli `final_days` päivää ennen hakua, eivät
+# enää muutu, joten niiden sivut kelpaavat pysyvästi. Tuoreempien ikkunoiden sivut haetaan uudelleen, kun ne ovat
+# `ttl` sekuntia vanhoja.
+
+class SearchCache:
+    def __init__(self, db: databases.Database, final_days: int, ttl: int):
+        self.db = db
+        self.final_days = final_days
+        self.ttl = ttl
+
+    async def load(self, key: str) -> Optional[Page]:
+        row = await self.db.fetch_one("""
+        SELECT content FROM search_cache WHERE key = :key AND (final = 1 OR date > datetime('now', :age));
+        """, {"key": key, "age": f"-{self.ttl} seconds"})
+        if not row:
+            return None
+
+        content = json.loads(row["content"])
+        return Page(content["results"], content["total"], cached=True)
+
+    async def save(self, key: str, window: Window, page: Page):
+        final = window.to_date < datetime.date.today() - datetime.timedelta(days=self.final_days)
+        await self.db.execute("""
+        INSERT OR REPLACE INTO search_cache (key, content, final, date) VALUES (:key, :content, :final, datetime('now'));
+        """, {"key": key, "content": json.dumps({"results": page.results, "total": page.total}), "final": int(final)})
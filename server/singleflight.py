@@ -0,0 +1,30 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+# Jaetut keskeneräiset laskennat. Kun useampi toimeksianto tarvitsee saman tuloksen (esim. saman artikkelin sisällön
+# tai jäsennyksen) yhtä aikaa, vain ensimmäinen laskee sen ja muut odottavat samaa tulosta. Avain poistetaan heti,
+# kun laskenta on valmis, joten myöhemmät kutsut käyttävät välimuistia tavalliseen tapaan.
+
+class SingleFlight:
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+
+        # Haetaan poikkeus, jottei asyncio varoita käsittelemättömästä poikkeuksesta, jos kukaan ei enää odota
+        if not future.cancelled():
+            future.exception()
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(call())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+
+        # Yhden odottajan peruminen (esim. toimeksianto keskeytyy) ei peru muiden odottamaa laskentaa
+        return await asyncio.shield(future)
@@ -0,0 +1,49 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import tempfile
+from typing import List, Tuple
+
+import databases
+
+# Haettujen artikkelien raaka-HTML. Tiedostot nimetään sisällön SHA-256-tiivisteellä ja pakataan gzipillä, joten sama
+# sivu tallennetaan vain kerran. Tietokannan snapshots-taulu kertoo, mikä tiedosto haettiin mistäkin osoitteesta ja
+# milloin. Tallennetuista sivuista voi poimia artikkelit uudelleen hakematta niitä (python -m server.reextract).
+
+def snapshot_path(directory: str, digest: str) -> str:
+    return os.path.join(directory, digest[:2], digest + ".html.gz")
+
+def write_snapshot(directory: str, html: str) -> str:
+    data = html.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    path = snapshot_path(directory, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Kirjoitetaan ensin väliaikaiseen tiedostoon, jottei keskeytynyt kirjoitus jää tiedostoksi. Jokainen kirjoitus
+        # saa oman väliaikaisen tiedostonsa, koska sama sivu voidaan tallentaa yhtä aikaa useammasta säikeestä.
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as tmp:
+            with gzip.GzipFile(fileobj=tmp, mode="wb") as f:
+                f.write(data)
+
+        os.replace(tmp.name, path)
+
+    return digest
+
+def read_snapshot(directory: str, digest: str) -> str:
+    with gzip.open(snapshot_path(directory, digest), "rb") as f:
+        return f.read().decode("utf-8")
+
+async def save_snapshot(db: databases.Database, directory: str, url: str, html: str):
+    loop = asyncio.get_event_loop()
+    digest = await loop.run_in_executor(None, write_snapshot, directory, html)
+    await db.execute("""
+    INSERT OR REPLACE INTO snapshots (url, date, hash) VALUES (:url, datetime('now'), :hash);
+    """, {"url": url, "hash": digest})
+
+# Palauttaa jokaisen osoitteen uusimman tallennetun sivun pareina `(url, tiiviste)`
+async def latest_snapshots(db: databases.Database) -> List[Tuple[str, str]]:
+    rows = await db.fetch_all("""
+    SELECT url, hash FROM snapshots AS s WHERE date = (SELECT MAX(date) FROM snapshots WHERE url = s.url);
+    """)
+    return [(row["url"], row["hash"]) for row in rows]
@@ -0,0 +1,230 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import zlib
+from typing import AsyncIterator, List, Optional
+
+import databases
+import pandas as pd
+from aiohttp import web
+
+from server.articles import load_articles
+from server.singleflight import SingleFlight
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Tulosten lähettäminen paloina. Tulos kootaan artikkelivarastosta CHUNK_ROWS rivin erissä ja pakataan sitä mukaa,
+# joten palvelimen muistiin ei koskaan tarvitse mahtua koko CSV-tiedostoa. Ennen artikkelivarastoa tallennetut
+# CSV-tulokset lähetetään CHUNK_BYTES tavun paloina.
+#
+# Osapyyntöjä (Range) varten tulos kootaan kerran CSV-tiedostoksi välimuistihakemistoon (Resources-osion
+# CacheDirectory), ja tiedosto nimetään ETagin mukaan. Jatketut lataukset lukevat saman tiedoston niin kauan, kuin
+# tulos ei muutu. Hakemistosta poistetaan vähiten aikaa sitten käytetyt tiedostot, kun niiden koko ylittää
+# CacheMaxMegabytes.
+
+logger = logging.getLogger("streaming")
+
+CHUNK_ROWS = 500
+CHUNK_BYTES = 1 << 20
+
+# Valitsee pakkauksen Accept-Encoding-otsakkeen perusteella. zstd on käytössä vain, jos zstandard on asennettu.
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    qualities = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        try:
+            qualities[name.strip().lower()] = float(match.group(1)) if match else 1.0
+
+        except ValueError:
+            qualities[name.strip().lower()] = 0.0
+
+    for encoding in (["zstd"] if zstandard else []) + ["gzip"]:
+        if qualities.get(encoding, qualities.get("*", 0.0)) > 0:
+            return encoding
+
+    return None
+
+class Encoder:
+    def __init__(self, encoding: Optional[str]):
+        if encoding == "gzip":
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        elif encoding == "zstd":
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+
+        else:
+            self.compressor = None
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data) if self.compressor else data
+
+    def flush(self) -> bytes:
+        return self.compressor.flush() if self.compressor else b""
+
+# Palauttaa tuloksen sarakkeet. Vanhoista CSV-tuloksista luetaan otsikkorivi (ensimmäinen sarake on indeksi).
+def resource_columns(row) -> List[str]:
+    if row["articles"] is None:
+        header = row["resource"].split("\n", 1)[0]
+        return list(pd.read_csv(io.StringIO(header), index_col=0).columns)
+
+    return json.loads(row["columns"])
+
+# Tuloksen versio: tunnisteet, sarakkeet ja tuloksen artikkelien viimeisin päivitysaika
+async def resource_etag(db: databases.Database, resource_id: str, row, columns: Optional[List[str]]) -> str:
+    if row["articles"] is None:
+        version = row["date"]
+
+    else:
+        updated = await db.fetch_one("""
+        SELECT MAX(date) AS date FROM articles WHERE id IN (SELECT value FROM json_each(:ids));
+        """, {"ids": row["articles"]})
+        version = updated["date"]
+
+    key = json.dumps([resource_id, columns, row["articles"], row["date"], version], default=str)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+async def resource_csv(db: databases.Database, row, columns: Optional[List[str]] = None) -> AsyncIterator[bytes]:
+    if row["articles"] is None:
+        text: str = row["resource"]
+        if columns is None:
+            data = text.encode("utf-8")
+            for start in range(0, len(data), CHUNK_BYTES):
+                yield data[start:start+CHUNK_BYTES]
+
+        else:
+            for i, df in enumerate(pd.read_csv(io.StringIO(text), index_col=0, chunksize=CHUNK_ROWS)):
+                yield df[columns].to_csv(header=i == 0).encode("utf-8")
+
+        return
+
+    ids: List[int] = json.loads(row["articles"])
+    columns = columns or json.loads(row["columns"])
+    if not ids:
+        yield pd.DataFrame(columns=columns).to_csv().encode("utf-8")
+        return
+
+    # Rivien numerointi jatkuu erästä toiseen kuten yhtenä taulukkona tallennetussa CSV:ssä
+    position = 0
+    for start in range(0, len(ids), CHUNK_ROWS):
+        df = await load_articles(db, ids[start:start+CHUNK_ROWS], columns)
+        df.index = range(position, position+len(df))
+        position += len(df)
+        yield df.to_csv(header=start == 0).encode("utf-8")
+
+# Palauttaa tuloksen CSV-tiedoston polun välimuistihakemistossa. Saman tuloksen samanaikaiset pyynnöt odottavat samaa
+# kokoamista.
+async def rendered_csv(app, row, columns: Optional[List[str]], etag: str) -> str:
+    directory: str = app["RESOURCE_CACHE_DIR"]
+    path = os.path.join(directory, etag + ".csv")
+    if os.path.exists(path):
+        # Muokkausaika kertoo, milloin tiedostoa on viimeksi käytetty
+        os.utime(path)
+        return path
+
+    async def render() -> str:
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as f:
+            try:
+                async for chunk in resource_csv(app["db"], row, columns):
+                    f.write(chunk)
+
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+
+        os.replace(f.name, path)
+        _prune(directory, app["RESOURCE_CACHE_BYTES"], path)
+        return path
+
+    singleflight: SingleFlight = app["singleflight"]
+    return await singleflight.do(("resource_csv", etag), render)
+
+def _prune(directory: str, max_bytes: int, keep: str):
+    files = []
+    for filename in os.listdir(directory):
+        if filename.endswith(".csv"):
+            stat = os.stat(os.path.join(directory, filename))
+            files.append((stat.st_mtime, stat.st_size, os.path.join(directory, filename)))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+
+        if path != keep:
+            os.remove(path)
+            total -= size
+
+# Lähettää tuloksen CSV-muodossa. Osapyyntöön vastataan koottua tiedostoa käyttäen, jos If-Range (jos annettu) vastaa
+# tuloksen ETagia. Muuten koko tulos lähetetään paloina ja pakataan, jos asiakas sen hyväksyy. Monen välin ja
+# virheelliset Range-otsakkeet ohitetaan, jolloin lähetetään koko tulos (RFC 9110).
+async def send_resource(request: web.Request, resource_id: str, row, columns: Optional[List[str]]) -> web.StreamResponse:
+    db: databases.Database = request.app["db"]
+    try:
+        http_range = request.http_range
+    
+    except ValueError:
+        http_range = slice(None, None)
+    
+    # ETag vaihtuu, jos jokin tuloksen artikkeleista on päivittynyt, joten jatkettu lataus ei yhdistä kahta versiota
+    etag = await resource_etag(db, resource_id, row, columns)
+    ranged = http_range.start is not None or http_range.stop is not None
+    if ranged and request.headers.get("If-Range", f'"{etag}"') != f'"{etag}"':
+        ranged = False
+    
+    response = web.StreamResponse(headers={"Accept-Ranges": "bytes", "Vary": "Accept-Encoding"})
+    response.content_type = "text/csv"
+    response.charset = "utf-8"
+
+    if ranged:
+        # Osa tuloksesta lähetetään pakkaamattomana, koska tavut lasketaan CSV-tiedostosta
+        path = await rendered_csv(request.app, row, columns, etag)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            start, stop, _ = http_range.indices(size)
+            if start >= stop:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{size}", "ETag": f'"{etag}"'})
+            
+            response.set_status(206)
+            response.headers["ETag"] = f'"{etag}"'
+            response.headers["Content-Range"] = f"bytes {start}-{stop-1}/{size}"
+            response.content_length = stop - start
+            await response.prepare(request)
+            f.seek(start)
+            while f.tell() < stop:
+                await response.write(f.read(min(CHUNK_BYTES, stop - f.tell())))
+        
+        await response.write_eof()
+        return response
+    
+    encoding = negotiate_encoding(request.headers.get("Accept-Encoding", ""))
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+        # Pakatulla esityksellä on eri tavut, joten sillä on myös eri ETag
+        response.headers["ETag"] = f'"{etag}-{encoding}"'
+    
+    else:
+        response.headers["ETag"] = f'"{etag}"'
+    
+    encoder = Encoder(encoding)
+    await response.prepare(request)
+    async for chunk in resource_csv(db, row, columns):
+        data = encoder.compress(chunk)
+        if data:
+            await response.write(data)
+    
+    data = encoder.flush()
+    if data:
+        await response.write(data)
+    
+    await response.write_eof()
+    return response
@@ -0,0 +1,96 @@
+import json
+import socket
+import os
+import uuid
+from typing import Any, Dict, NamedTuple, Optional
+
+import databases
+from aiohttp import web
+
+# Toimeksiantojen jono tietokannassa. Työntekijä varaa toimeksiannon määräajaksi (lease) ja uusii varauksen
+# säännöllisesti. Jos työntekijä kaatuu, varaus vanhenee ja toimeksianto otetaan uudelleen käsittelyyn.
+
+class Job(NamedTuple):
+    ticket_id: str
+    kind: str
+    params: Dict[str, Any]
+    claim: str
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+async def enqueue(db: databases.Database, kind: str, params: Dict[str, Any], priority: int = 0) -> str:
+    ticket_id = str(uuid.uuid4())
+    await db.execute("""
+    INSERT INTO tickets(uuid, status, date, kind, params, priority) VALUES (:id, 'queued', datetime('now'), :kind, :params, :priority);
+    """, {"id": ticket_id, "kind": kind, "params": json.dumps(params), "priority": priority})
+    return ticket_id
+
+def notify(app: web.Application):
+    if "job_event" in app:
+        app["job_event"].set()
+
+async def queue_position(db: databases.Database, ticket_id: str) -> Optional[int]:
+    # Jono järjestetään ensin prioriteetin ja sitten saapumisjärjestyksen mukaan
+    row = await db.fetch_one("""
+    SELECT COUNT(other.uuid) AS position FROM tickets AS ticket
+    JOIN tickets AS other ON other.status = 'queued' AND (
+        other.priority > ticket.priority OR (other.priority = ticket.priority AND other.rowid <= ticket.rowid)
+    )
+    WHERE ticket.uuid = :id AND ticket.status = 'queued';
+    """, {"id": ticket_id})
+    return row["position"] if row and row["position"] else None
+
+async def claim_next(db: databases.Database, lease: int) -> Optional[Job]:
+    claim = str(uuid.uuid4())
+    await db.execute(f"""
+    UPDATE tickets SET status = 'in progress', claim = :claim, worker = :worker, lease_expires = datetime('now', '+{int(lease)} seconds')
+    WHERE uuid = (
+        SELECT uuid FROM tickets
+        WHERE status = 'queued' OR (status = 'in progress' AND lease_expires < datetime('now'))
+        ORDER BY priority DESC, rowid ASC LIMIT 1
+    );
+    """, {"claim": claim, "worker": worker_name()})
+    row = await db.fetch_one("SELECT uuid, kind, params FROM tickets WHERE claim = :claim;", {"claim": claim})
+    if not row:
+        return None
+    
+    return Job(row["uuid"], row["kind"], json.loads(row["params"]), claim)
+
+async def renew_lease(db: databases.Database, job: Job, lease: int) -> bool:
+    await db.execute(f"""
+    UPDATE tickets SET lease_expires = datetime('now', '+{int(lease)} seconds') WHERE uuid = :id AND claim = :claim;
+    """, {"id": job.ticket_id, "claim": job.claim})
+    row = await db.fetch_one("SELECT claim FROM tickets WHERE uuid = :id;", {"id": job.ticket_id})
+    return bool(row) and row["claim"] == job.claim
+
+async def release(db: databases.Database, job: Job):
+    await db.execute("""
+    UPDATE tickets SET lease_expires = NULL WHERE uuid = :id AND claim = :claim;
+    """, {"id": job.ticket_id, "claim": job.claim})
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    
+    except ProcessLookupError:
+        return False
+    
+    except PermissionError:
+        pass
+    
+    return True
+
+async def recover(db: databases.Database):
+    # Ennen jonoa aloitettuja toimeksiantoja ei voi jatkaa
+    await db.execute("UPDATE tickets SET status = 'interrupted' WHERE status = 'in progress' AND params IS NULL;")
+
+    # Tällä koneella kaatuneiden prosessien toimeksiannot palautetaan jonoon heti eikä vasta varauksen
+    # vanhennuttua. Ne jatketaan viimeisestä tallennetusta työvaiheesta.
+    hostname = socket.gethostname()
+    rows = await db.fetch_all("SELECT uuid, worker FROM tickets WHERE status = 'in progress' AND worker LIKE :host;", {"host": hostname + ":%"})
+    for row in rows:
+        if not _is_alive(int(row["worker"].rsplit(":", 1)[1])):
+            await db.execute("""
+            UPDATE tickets SET status = 'queued', claim = NULL, lease_expires = NULL WHERE uuid = :id AND worker = :worker;
+            """, {"id": row["uuid"], "worker": row["worker"]})
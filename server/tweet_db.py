@@ -1,85 +1,299 @@
-from collections import defaultdict, Counter
-import json
+from collections import Counter
 import os
-from typing import Dict, List, NamedTuple
+import sys
+from typing import Dict, List, NamedTuple, Optional, Tuple
 import logging
 
+import numpy as np
 import pandas as pd
 
+from scrapers.tweet_store import find_tweet_file, iter_tweet_file, list_tweet_files
+
 logger = logging.getLogger("tweet_db")
 
+EDGE_TYPES = ["replied_to", "quoted", "retweeted"]
+# Taulukon sarakkeet, joihin tviittiin reagoineet käyttäjät (tai niiden määrät, sarake + "_count") tallennetaan
+INTERACTION_COLUMNS = {"replied_to": "repliers", "quoted": "quoters", "retweeted": "retweeters"}
+
+# Interaktiograafi CSR-muodossa: reunatyypille `type` lista `indices[type][indptr[type][i]:indptr[type][i+1]]`
+# sisältää niiden käyttäjien indeksit (`usernames`-listaan), jotka ovat vastanneet, lainanneet tai uudelleentviitanneet
+# tietokannan `i`:nnettä tviittiä.
+class InteractionGraph(NamedTuple):
+    usernames: List[str]
+    indptr: Dict[str, np.ndarray]
+    indices: Dict[str, np.ndarray]
+
+    def users_of(self, tweet: int, type: str) -> np.ndarray:
+        return self.indices[type][self.indptr[type][tweet]:self.indptr[type][tweet+1]]
+
+    def counter(self, tweet: int, type: str) -> Dict[str, int]:
+        return dict(Counter(self.usernames[u] for u in self.users_of(tweet, type)))
+
+    def degrees(self, type: str) -> np.ndarray:
+        return np.diff(self.indptr[type])
+
+    def edges(self, type: str) -> pd.DataFrame:
+        return pd.DataFrame({
+            "tweet": np.repeat(np.arange(len(self.indptr[type])-1), self.degrees(type)),
+            "user": self.indices[type],
+        })
+
+# Tviitit tallennetaan sarakkeittain numpy-taulukoihin id:n mukaan järjestettyinä. Id:t ovat kokonaislukuja
+# (0 tarkoittaa puuttuvaa arvoa), käyttäjänimet ovat internoituja merkkijonoja ja tekstit ovat yhdessä
+# UTF-8-puskurissa, josta tviitin `i` teksti on `text_buffer[text_offsets[i]:text_offsets[i+1]]`.
 class TweetDatabase(NamedTuple):
-    tweets: Dict[str, dict]
-    users: Dict[str, dict]
-    author_tweets: Dict[str, List[dict]]
+    ids: np.ndarray
+    author: np.ndarray
+    created_at: np.ndarray
+    in_reply_to_user_id: np.ndarray
+    reply_count: np.ndarray
+    like_count: np.ndarray
+    quote_count: np.ndarray
+    retweet_count: np.ndarray
+    referenced: Dict[str, np.ndarray]
+    text_buffer: bytes
+    text_offsets: np.ndarray
+    user_ids: np.ndarray
+    usernames: List[str]
+    # Käyttäjänimen ensimmäinen indeksi `usernames`-listassa
+    username_index: Dict[str, int]
+    names: List[str]
+    graph: InteractionGraph
+    mentions: pd.DataFrame
+    hashtags: pd.DataFrame
+
+    def __len__(self):
+        return len(self.ids)
+
+    def text(self, i: int) -> str:
+        return self.text_buffer[self.text_offsets[i]:self.text_offsets[i+1]].decode("utf-8")
+
+    def texts(self) -> List[str]:
+        return [self.text(i) for i in range(len(self))]
+
+    def tag_lists(self, tags: pd.DataFrame, index: pd.Index) -> pd.Series:
+        # Palauttaa `mentions`- tai `hashtags`-taulun rivit listoina annetuille tviittiriveille
+        tags = tags[tags.tweet.isin(index)]
+        lists = tags["tag"].astype(object).groupby(tags["tweet"]).agg(list)
+        return lists.reindex(index).map(lambda l: l if isinstance(l, list) else [])
+
+    def author_tweets(self, username: str) -> np.ndarray:
+        if username not in self.username_index:
+            raise ValueError(f"Unknown username {username}")
+
+        return np.nonzero(self.author == self.username_index[username])[0]
+
+    # Palauttaa riveittäin sanakirjat käyttäjänimestä reaktioiden määrään
+    def interaction_users(self, type: str, index: pd.Index) -> List[Dict[str, int]]:
+        return [self.graph.counter(i, type) for i in index]
 
     def to_dataframe(self):
         logger.info(f"Preprocessing tweets (phase 3)...")
-        df = pd.DataFrame(list(self.tweets.values()))
-        df["created_at"] = pd.to_datetime(df["created_at"], utc=True).dt.tz_convert("Europe/Helsinki")
-        
-        df["retweet_count"] = df["public_metrics"].map(lambda a: a["retweet_count"])
-        df["reply_count"] = df["public_metrics"].map(lambda a: a["reply_count"])
-        df["like_count"] = df["public_metrics"].map(lambda a: a["like_count"])
-        df["quote_count"] = df["public_metrics"].map(lambda a: a["quote_count"])
-        del df["retweet_count"]
+        df = pd.DataFrame({
+            "id": self.ids,
+            "text": self.texts(),
+            "created_at": pd.to_datetime(self.created_at, utc=True).tz_convert("Europe/Helsinki"),
+            "author_id": self.user_ids[self.author],
+            "in_reply_to_user_id": _nullable_ids(self.in_reply_to_user_id),
+            "reply_count": self.reply_count,
+            "like_count": self.like_count,
+            "quote_count": self.quote_count,
+        })
 
         df["reply_like_ratio"] = df["reply_count"] / df["like_count"]
 
-        df["replied_to"] = df["referenced_tweets"].map(lambda a: _get_referenced_tweet_id(a, "replied_to"))
-        df["retweeted"] = df["referenced_tweets"].map(lambda a: _get_referenced_tweet_id(a, "retweeted"))
-        df["quoted"] = df["referenced_tweets"].map(lambda a: _get_referenced_tweet_id(a, "quoted"))
-        del df["referenced_tweets"]
+        for type in EDGE_TYPES:
+            df[type] = _nullable_ids(self.referenced[type])
 
-        df["repliers"] = df["repliers"].map(dict)
-        df["quoters"] = df["quoters"].map(dict)
-        df["retweeters"] = df["retweeters"].map(dict)
+        # Käyttäjäkohtaiset määrät saa interaction_users-metodilla vain tarvittaville riveille
+        for type, column in INTERACTION_COLUMNS.items():
+            df[column + "_count"] = self.graph.degrees(type)
 
-        df["author_name"] = df["author_id"].map(lambda id: self.users[id]["name"])
-        df["author_username"] = df["author_id"].map(lambda id: self.users[id]["username"])
+        df["author_name"] = np.array(self.names, dtype=object)[self.author]
+        df["author_username"] = np.array(self.usernames, dtype=object)[self.author]
 
         return df
 
-def _get_referenced_tweet_id(referenced_tweets, type):
-    if not referenced_tweets or not isinstance(referenced_tweets, list):
-        return None
-    
-    for rt in referenced_tweets:
-        if rt["type"] == type:
-            return rt["id"]
-    
-    return None
-
-def load_tweet_database(*filenames):
-    tweets = {}
-    users = {}
-    for filename in os.listdir("tweets") if not filenames else [fn + ".json" for fn in filenames]:
-        logger.info(f"Loading tweet file {filename}...")
-        with open(os.path.join("tweets", filename), "r") as f:
-            data = json.load(f)
-
-        tweets.update(data["tweets"])
-        users.update(data["users"])
-    
-    logger.info(f"Preprocessing tweets (phase 1)...")
-    author_tweets = defaultdict(list)
-    for tweet in tweets.values():
-        tweet["repliers"] = Counter()
-        tweet["quoters"] = Counter()
-        tweet["retweeters"] = Counter()
-        author_tweets[tweet["author_id"]].append(tweet)
-    
+def _nullable_ids(ids: np.ndarray) -> pd.array:
+    return pd.array(np.where(ids == 0, None, ids), dtype="Int64")
+
+def _int_id(id) -> int:
+    return int(id) if id else 0
+
+class _TweetDatabaseBuilder:
+    def __init__(self):
+        self.positions: Dict[int, int] = {}
+        self.rows: List[tuple] = []
+        self.texts: List[bytes] = []
+        self.user_index: Dict[int, int] = {}
+        self.user_ids: List[int] = []
+        self.usernames: List[str] = []
+        self.names: List[str] = []
+
+    def add_user(self, user: dict):
+        id = int(user["id"])
+        username = sys.intern(user.get("username", ""))
+        name = sys.intern(user.get("name", ""))
+        if id in self.user_index:
+            self.usernames[self.user_index[id]] = username
+            self.names[self.user_index[id]] = name
+
+        else:
+            self.user_index[id] = len(self.user_ids)
+            self.user_ids.append(id)
+            self.usernames.append(username)
+            self.names.append(name)
+
+    def _user(self, id: int) -> int:
+        if id not in self.user_index:
+            self.add_user({"id": id})
+
+        return self.user_index[id]
+
+    def add_tweet(self, tweet: dict):
+        references = {rt["type"]: rt["id"] for rt in tweet.get("referenced_tweets", [])}
+        metrics = tweet.get("public_metrics", {})
+        row = (
+            int(tweet["id"]),
+            self._user(int(tweet["author_id"])),
+            tweet["created_at"],
+            _int_id(tweet.get("in_reply_to_user_id")),
+            metrics.get("reply_count", 0),
+            metrics.get("like_count", 0),
+            metrics.get("quote_count", 0),
+            metrics.get("retweet_count", 0),
+            *(_int_id(references.get(type)) for type in EDGE_TYPES),
+        )
+        text = tweet.get("text", "").encode("utf-8")
+        if row[0] in self.positions:
+            self.rows[self.positions[row[0]]] = row
+            self.texts[self.positions[row[0]]] = text
+
+        else:
+            self.positions[row[0]] = len(self.rows)
+            self.rows.append(row)
+            self.texts.append(text)
+
+    def build(self) -> TweetDatabase:
+        columns = list(zip(*self.rows)) if self.rows else [()] * (8 + len(EDGE_TYPES))
+        self.rows = []
+        ids = np.array(columns[0], dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+
+        def column(i: int, dtype) -> np.ndarray:
+            return np.array(columns[i], dtype=dtype)[order]
+
+        lengths = np.array([len(self.texts[i]) for i in order], dtype=np.int64)
+        text_buffer = b"".join(self.texts[i] for i in order)
+        texts = pd.Series([self.texts[i] for i in order], dtype=object).str.decode("utf-8")
+        self.texts = []
+        mentions = _extract_tags(texts, r"(@\w+)")
+        hashtags = _extract_tags(texts, r"(#\w+)")
+        del texts
+
+        author = column(1, np.int32)
+        referenced = {type: column(8+j, np.int64) for j, type in enumerate(EDGE_TYPES)}
+        return TweetDatabase(
+            ids=ids[order],
+            author=author,
+            created_at=pd.to_datetime(np.array(columns[2], dtype=object)[order], utc=True).values,
+            in_reply_to_user_id=column(3, np.int64),
+            reply_count=column(4, np.int32),
+            like_count=column(5, np.int32),
+            quote_count=column(6, np.int32),
+            retweet_count=column(7, np.int32),
+            referenced=referenced,
+            text_buffer=text_buffer,
+            text_offsets=np.concatenate([[0], np.cumsum(lengths)]),
+            user_ids=np.array(self.user_ids, dtype=np.int64),
+            usernames=self.usernames,
+            username_index={username: i for i, username in reversed(list(enumerate(self.usernames)))},
+            names=self.names,
+            graph=_build_interaction_graph(ids[order], author, referenced, self.usernames),
+            mentions=mentions,
+            hashtags=hashtags,
+        )
+
+# Mainintojen ja aihetunnisteiden taulut: yksi rivi jokaista tviitin (rivinumero) tunnistetta kohden
+def _extract_tags(texts: pd.Series, pattern: str) -> pd.DataFrame:
+    if texts.empty:
+        return pd.DataFrame({"tweet": np.array([], dtype=np.int32), "tag": pd.Categorical([])})
+
+    matches = texts.str.extractall(pattern)[0]
+    return pd.DataFrame({
+        "tweet": matches.index.get_level_values(0).to_numpy(dtype=np.int32),
+        "tag": pd.Categorical(matches.to_numpy()),
+    })
+
+def load_tweet_database(*filenames, from_date: Optional[str] = None, to_date: Optional[str] = None):
+    if filenames:
+        paths = []
+        for filename in filenames:
+            path = find_tweet_file("tweets", filename)
+            if not path:
+                raise FileNotFoundError(f"No tweet file for {filename}")
+
+            paths.append(path)
+
+    else:
+        paths = list_tweet_files("tweets")
+
+    builder = _TweetDatabaseBuilder()
+    for path in paths:
+        logger.info(f"Loading tweet file {path}...")
+        for type, record in iter_tweet_file(path, from_date, to_date):
+            if type == "user":
+                builder.add_user(record)
+
+            else:
+                builder.add_tweet(record)
+
     logger.info(f"Preprocessing tweets (phase 2)...")
-    for tweet in tweets.values():
-        for rt in tweet.get("referenced_tweets", []):
-            if rt["id"] in tweets:
-                if rt["type"] == "replied_to":
-                    tweets[rt["id"]]["repliers"][users[tweet["author_id"]]["username"]] += 1
-
-                elif rt["type"] == "quoted":
-                    tweets[rt["id"]]["quoters"][users[tweet["author_id"]]["username"]] += 1
-
-                elif rt["type"] == "retweeted":
-                    tweets[rt["id"]]["retweeters"][users[tweet["author_id"]]["username"]] += 1
-    
-    return TweetDatabase(tweets, users, dict(author_tweets))
\ No newline at end of file
+    return builder.build()
+
+def _build_interaction_graph(ids: np.ndarray, author: np.ndarray, referenced: Dict[str, np.ndarray], usernames: List[str]) -> InteractionGraph:
+    indptr = {}
+    indices = {}
+    for type in EDGE_TYPES:
+        sources = np.nonzero(referenced[type])[0]
+        targets = np.searchsorted(ids, referenced[type][sources])
+        found = targets < len(ids)
+        found[found] = ids[targets[found]] == referenced[type][sources[found]]
+        sources = sources[found]
+        targets = targets[found]
+
+        order = np.argsort(targets, kind="stable")
+        indptr[type] = np.concatenate([[0], np.cumsum(np.bincount(targets, minlength=len(ids)))])
+        indices[type] = author[sources[order]]
+
+    return InteractionGraph(usernames, indptr, indices)
+
+# Käyttäjien metatiedot (UserMetadata-asetus) ladataan kerran ja ladataan uudestaan vain, jos tiedosto muuttuu.
+class UserMetadata(NamedTuple):
+    table: pd.DataFrame
+    rows: Dict[str, int]
+
+_metadata_cache: Dict[str, Tuple[float, UserMetadata]] = {}
+
+def load_user_metadata(filename: str) -> UserMetadata:
+    mtime = os.path.getmtime(filename)
+    if filename not in _metadata_cache or _metadata_cache[filename][0] != mtime:
+        logger.info(f"Loading user metadata {filename}...")
+        table = pd.read_csv(filename)
+        rows: Dict[str, int] = {}
+        for i, username in enumerate(table["twitter"]):
+            rows.setdefault(username, i)
+
+        _metadata_cache[filename] = (mtime, UserMetadata(table, rows))
+
+    return _metadata_cache[filename][1]
+
+def join_user_metadata(tweets: pd.DataFrame, metadata: UserMetadata) -> pd.DataFrame:
+    row_ids = tweets["author_username"].map(metadata.rows).fillna(-1).astype(int)
+    joined = metadata.table.reindex(row_ids.values)
+    joined.index = tweets.index
+    overlap = tweets.columns.intersection(joined.columns)
+    return pd.concat([
+        tweets.rename(columns={c: c + "_x" for c in overlap}),
+        joined.rename(columns={c: c + "_y" for c in overlap}),
+    ], axis=1)
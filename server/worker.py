@@ -0,0 +1,40 @@
+import argparse
+import asyncio
+import logging
+
+from aiohttp import web
+
+from scrapers import client
+from server.config import load_config
+import server.jobs as jobs
+import server.ticket_queue as ticket_queue
+
+# Erillinen työntekijäprosessi, joka käsittelee tietokannan jonossa olevia toimeksiantoja:
+#
+#     python -m server.worker --workers 2
+#
+# Työntekijöitä voi ajaa useita samalla tai eri koneilla, kunhan ne käyttävät samaa tietokantaa.
+
+logging.basicConfig(filename='worker.log', level=logging.INFO)
+
+async def main(workers: int):
+    app = web.Application()
+    load_config(app)
+    if workers:
+        app["QUEUE_WORKERS"] = workers
+    
+    await ticket_queue.recover(app["db"])
+    async with client.create_session() as session:
+        app["client_session"] = session
+        await jobs.start_workers(app)
+        try:
+            await asyncio.gather(*app["workers"])
+        
+        finally:
+            await jobs.stop_workers(app)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process queued scrape tickets")
+    parser.add_argument("--workers", type=int, default=0, help="number of concurrent tickets (default: [Queue] Workers)")
+    args = parser.parse_args()
+    asyncio.run(main(args.workers))
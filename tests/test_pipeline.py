@@ -0,0 +1,59 @@
+import asyncio
+
+from server.pipeline import Item, Pipeline, Stage
+
+async def _items(n, fail=False):
+    for i in range(n):
+        yield Item(i, {"url": f"u{i}"})
+
+    if fail:
+        raise RuntimeError("search failed")
+
+def test_results_by_stage():
+    async def double(item):
+        return (item.index * 2,)
+
+    async def add(item):
+        return (item.row["double"] + 1,)
+
+    stages = [
+        Stage("double", ["double"], double, (None,), 2),
+        Stage("add", ["add"], add, (None,), 1, "double"),
+    ]
+    results = asyncio.run(Pipeline(stages).run(_items(5)))
+    assert results["add"] == {i: (i*2+1,) for i in range(5)}
+
+def test_failing_input_cancels_busy_workers():
+    async def slow(item):
+        await asyncio.sleep(5)
+        return (1,)
+
+    async def main():
+        pipeline = Pipeline([Stage("slow", ["slow"], slow, (None,), 2)])
+        await asyncio.wait_for(pipeline.run(_items(2, fail=True)), 2)
+
+    try:
+        asyncio.run(main())
+        assert False, "the pipeline should fail"
+
+    except RuntimeError:
+        pass
+
+def test_cancel_during_processing():
+    async def main():
+        event = asyncio.Event()
+        async def slow(item):
+            event.set()
+            await asyncio.sleep(5)
+            return (1,)
+
+        task = asyncio.create_task(Pipeline([Stage("slow", ["slow"], slow, (None,), 2)]).run(_items(4)))
+        await event.wait()
+        task.cancel()
+        try:
+            await asyncio.wait_for(task, 2)
+
+        except asyncio.CancelledError:
+            return True
+
+    assert asyncio.run(main())
@@ -0,0 +1,25 @@
+import asyncio
+import datetime
+
+from scrapers.query import Page, PaginatedQuery, Params
+
+class EndlessQuery(PaginatedQuery):
+    CONCURRENCY = 1
+
+    async def _fetch_page(self, session, window):
+        return Page([{"url": f"{window.from_date}/{window.offset + i}"} for i in range(self.params.limit)])
+
+def test_consumer_stopping_early_stops_search():
+    async def run():
+        before = asyncio.all_tasks()
+        query = EndlessQuery(Params("", datetime.date(2021, 1, 4), datetime.date(2021, 12, 31), limit=10, delay=0))
+        results = query.iter_results(None)
+        # Haku jatkuu, kunnes sivujono on täynnä
+        await results.__anext__()
+        await asyncio.sleep(0.1)
+        await results.aclose()
+
+        # Perutun haun tehtävä ei saa jäädä odottamaan täyttä jonoa
+        assert asyncio.all_tasks() == before
+
+    asyncio.run(asyncio.wait_for(run(), 5))
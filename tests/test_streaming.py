@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+
+import databases
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from server import streaming
+from server.singleflight import SingleFlight
+from server.streaming import negotiate_encoding, resource_csv, send_resource
+
+@pytest.mark.parametrize("header, expected", [
+    ("", None),
+    ("gzip", "gzip"),
+    ("gzip;q=0", None),
+    ("br, gzip;q=0.5", "gzip"),
+    ("identity", None),
+    ("*", "zstd" if streaming.zstandard else "gzip"),
+    ("zstd", "zstd" if streaming.zstandard else None),
+    ("gzip;q=.", None),
+])
+def test_negotiate_encoding(header, expected):
+    assert negotiate_encoding(header) == expected
+
+ARTICLES = [{"url": f"https://example.com/{i}", "content": f"teksti {i}"} for i in range(20)]
+
+async def _client(tmp_path):
+    db = databases.Database(f"sqlite:///{tmp_path}/test.db")
+    await db.connect()
+    await db.execute("CREATE TABLE articles (id INTEGER PRIMARY KEY, url TEXT UNIQUE, content TEXT, date TEXT);")
+    for article in ARTICLES:
+        await db.execute(
+            "INSERT INTO articles (url, content, date) VALUES (:url, :content, '2021-01-01 00:00:00');",
+            {"url": article["url"], "content": json.dumps(article)},
+        )
+
+    row = {"resource": None, "articles": json.dumps(list(range(1, len(ARTICLES)+1))), "columns": json.dumps(["url", "content"]), "date": "2021-01-01 00:00:00"}
+
+    async def handler(request):
+        columns = request.query["columns"].split(",") if "columns" in request.query else None
+        return await send_resource(request, "r", row, columns)
+
+    app = web.Application()
+    app["db"] = db
+    app["singleflight"] = SingleFlight()
+    app["RESOURCE_CACHE_DIR"] = str(tmp_path / "cache")
+    app["RESOURCE_CACHE_BYTES"] = 1 << 20
+    app.router.add_get("/resource", handler)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    return client, db, row
+
+def _run(tmp_path, test):
+    async def run():
+        client, db, row = await _client(tmp_path)
+        try:
+            await test(client, db, row)
+
+        finally:
+            await client.close()
+            await db.disconnect()
+
+    asyncio.run(run())
+
+def test_full_and_projected(tmp_path):
+    async def test(client, db, row):
+        full = b"".join([chunk async for chunk in resource_csv(db, row)])
+        response = await client.get("/resource")
+        assert response.status == 200
+        assert await response.read() == full
+        assert response.headers["Content-Encoding"] == negotiate_encoding("gzip, deflate")
+
+        response = await client.get("/resource", params={"columns": "url"})
+        lines = (await response.text()).splitlines()
+        assert lines[0] == ",url"
+        assert lines[1] == "0,https://example.com/0"
+
+    _run(tmp_path, test)
+
+def test_range_and_if_range(tmp_path):
+    async def test(client, db, row):
+        full = b"".join([chunk async for chunk in resource_csv(db, row)])
+        response = await client.get("/resource", headers={"Range": "bytes=10-29"})
+        assert response.status == 206
+        assert await response.read() == full[10:30]
+        assert response.headers["Content-Range"] == f"bytes 10-29/{len(full)}"
+        etag = response.headers["ETag"]
+        assert len(os.listdir(client.app["RESOURCE_CACHE_DIR"])) == 1
+
+        response = await client.get("/resource", headers={"Range": "bytes=30-", "If-Range": etag})
+        assert response.status == 206
+        assert await response.read() == full[30:]
+
+        # Muuttunut tulos lähetetään kokonaan
+        await db.execute("UPDATE articles SET date = '2021-02-01 00:00:00' WHERE id = 1;")
+        response = await client.get("/resource", headers={"Range": "bytes=30-", "If-Range": etag, "Accept-Encoding": "identity"})
+        assert response.status == 200
+        assert await response.read() == full
+
+        response = await client.get("/resource", headers={"Range": f"bytes={len(full)+10}-"})
+        assert response.status == 416
+        assert response.headers["Content-Range"] == f"bytes */{len(full)}"
+
+        # Monen välin pyyntöön vastataan koko tuloksella
+        response = await client.get("/resource", headers={"Range": "bytes=0-1,5-6", "Accept-Encoding": "identity"})
+        assert response.status == 200
+        assert await response.read() == full
+
+    _run(tmp_path, test)
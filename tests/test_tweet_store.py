@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from scrapers import tweet_store
+from scrapers.tweet_store import TweetWriter, iter_tweet_file, list_tweet_files
+
+EXTENSIONS = [".ndjson.gz"] + ([".ndjson.zst"] if tweet_store.zstandard else [])
+
+def _tweet(i):
+    return {"id": str(i), "created_at": f"2021-01-0{i}T12:00:00.000Z", "text": f"tweet {i}"}
+
+def _write(path, pages):
+    with TweetWriter(path) as writer:
+        for page in pages:
+            writer.write_page(page, [{"id": "u1", "username": "user"}])
+
+@pytest.mark.parametrize("extension", EXTENSIONS)
+def test_round_trip(tmp_path, extension):
+    path = str(tmp_path / f"tweets{extension}")
+    _write(path, [[_tweet(1), _tweet(2)]])
+    # Uudelleen avattu tiedosto jatkuu uudella pakatulla osalla
+    _write(path, [[_tweet(3)]])
+
+    records = list(iter_tweet_file(path))
+    assert [record["id"] for type, record in records if type == "tweet"] == ["1", "2", "3"]
+    assert sum(type == "user" for type, _ in records) == 2
+
+    # Sivut, joiden tviitit ovat välin ulkopuolella, ohitetaan
+    records = list(iter_tweet_file(path, from_date="2021-01-03"))
+    assert [record["id"] for type, record in records if type == "tweet"] == ["3"]
+
+@pytest.mark.parametrize("extension", EXTENSIONS)
+def test_unclosed_writer_is_not_listed(tmp_path, extension):
+    path = str(tmp_path / f"tweets{extension}")
+    writer = TweetWriter(path).__enter__()
+    writer.write_page([_tweet(1)], [])
+    assert list_tweet_files(str(tmp_path)) == []
+
+    writer.close()
+    assert list_tweet_files(str(tmp_path)) == [path]
+    assert not os.path.exists(path + tweet_store.PART_SUFFIX)
+
+@pytest.mark.parametrize("extension", EXTENSIONS)
+def test_truncated_file(tmp_path, extension):
+    path = str(tmp_path / f"tweets{extension}")
+    _write(path, [[_tweet(1), _tweet(2)]])
+    size = os.path.getsize(path)
+    _write(path, [[_tweet(3), _tweet(4)]])
+
+    # Katkaistaan toinen pakattu osa keskeltä
+    with open(path, "r+b") as f:
+        f.truncate(size + (os.path.getsize(path) - size) // 2)
+
+    records = list(iter_tweet_file(path))
+    ids = [record["id"] for type, record in records if type == "tweet"]
+    assert ids[:2] == ["1", "2"]
+    assert "4" not in ids